@@ -10,5 +10,7 @@ echo "Authors:"
 read authors
 
 
-wget -c "$url"
+# download the file and create its torrent in one pass (resuming earlier
+# downloads), upload.py then reuses the torrent
+python3 $DIR/download.py -p 32768 -c "Torrent created with https://github.com/AcademicTorrents/academictorrents_uploader" -o "${url##*/}.torrent" "$url" "${url##*/}" || exit 1
 python3 $DIR/upload.py "$(cat $DIR/key)" "${url##*/}" "$name" "$authors" "@article{,title={$name}}" dataset "" "$url"
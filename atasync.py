@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+asyncio interface for creating torrents and uploading them to the Academic
+Torrents API, so that many datasets can be processed concurrently by one
+event loop without blocking it.
+
+Licensed according to GPL v3.
+"""
+
+import asyncio
+import http.client
+import io
+import itertools
+import os
+import ssl
+import threading
+import urllib.parse
+
+from urllib.error import HTTPError
+
+from atclient import (API_URL, MultipartBody, retry_delay,
+                      RETRY_STATUSES)
+from py3createtorrent import write_bencoded
+from torrent import make_metainfo
+
+__all__ = ['build_torrent', 'TorrentBuild', 'upload']
+
+class _Aborted(Exception):
+    """Raised within hash_files() to abort a cancelled build."""
+    pass
+
+class TorrentBuild(object):
+    """
+    A torrent being created on an executor (see build_torrent()).
+
+    Awaiting the build returns the metainfo dictionary of the torrent.
+    Iterating over it asynchronously yields tuples (done, total) of the
+    bytes hashed so far as long as the build is running. Progress reported
+    faster than it is consumed is coalesced, so a slow (or no) consumer
+    does not hold up the hashing.
+
+    Cancelling the build (or a task awaiting it) stops the hashing at the
+    next block read.
+    """
+    def __init__(self, node, output=None, executor=None, **options):
+        loop = asyncio.get_running_loop()
+
+        self.node   = node
+        self.output = output
+        self.done   = 0
+        self.total  = None
+
+        self._changed = asyncio.Event()
+        self._aborted = threading.Event()
+
+        self._future = loop.run_in_executor(executor, self._build, loop,
+                                            options)
+        self._future.add_done_callback(self._finished)
+
+    def _build(self, loop, options):
+        """Create the torrent (on the executor)."""
+        def progress(done, total):
+            if self._aborted.is_set():
+                raise _Aborted()
+            loop.call_soon_threadsafe(self._report, done, total)
+
+        metainfo = make_metainfo(self.node, progress=progress, **options)
+        if self.output is not None:
+            write_bencoded(self.output, metainfo)
+
+        return metainfo
+
+    def _report(self, done, total):
+        self.done, self.total = done, total
+        self._changed.set()
+
+    def _finished(self, future):
+        if future.cancelled():
+            self._aborted.set()
+        self._changed.set()
+
+    def cancel(self):
+        """Stop creating the torrent."""
+        self._aborted.set()
+        return self._future.cancel()
+
+    def __await__(self):
+        return self._future.__await__()
+
+    async def __aiter__(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+
+            if self.total is not None:
+                yield self.done, self.total
+
+            if self._future.done():
+                return
+
+def build_torrent(node, output=None, executor=None, **options):
+    """
+    Start creating a torrent for the given file or directory on the given
+    executor (default: the loop's default executor) and return the
+    TorrentBuild, which can be awaited and iterated over asynchronously:
+
+        build = build_torrent(path, "data.torrent", workers=4)
+        async for done, total in build:
+            ...
+        metainfo = await build
+
+    The torrent is written to output, if given. Further keyword arguments
+    are passed on to torrent.make_metainfo().
+
+    Must be called from within a running event loop.
+    """
+    return TorrentBuild(node, output, executor, **options)
+
+async def upload(torrent, fields, url=API_URL, file_field='file',
+                 base64=True, retries=3, backoff=1.0, max_backoff=60.0,
+                 timeout=60):
+    """
+    Upload a torrent along with the given form fields and return the body
+    of the response, like atclient.APIClient.upload_torrent(), but on the
+    event loop.
+
+    The connection is made with asyncio streams. Blocks of torrent files
+    are read on the default executor. timeout applies to each step of the
+    exchange (connecting, sending a block, receiving the response), not
+    to the whole upload. Failures are retried like by APIClient.
+
+    @raise HTTPError: if the server responds with an error.
+    @raise OSError:   if the server cannot be reached.
+    """
+    filename = os.path.basename(torrent) if isinstance(torrent, str) \
+               else 'file.torrent'
+    body = MultipartBody(fields, file_field, torrent, filename, base64)
+
+    headers = {
+        'Content-Type':   body.content_type,
+        'Content-Length': str(len(body)),
+    }
+
+    for attempt in itertools.count():
+        retry_after = None
+        try:
+            status, reason, response_headers, data = \
+                await _request(url, 'POST', body, headers, timeout)
+        except (OSError, asyncio.TimeoutError, http.client.HTTPException) \
+               as exc:
+            error = exc
+        else:
+            if status < 300:
+                return data
+
+            error = HTTPError(url, status, reason, response_headers,
+                              io.BytesIO(data))
+            if status not in RETRY_STATUSES:
+                raise error
+
+            retry_after = response_headers.get('Retry-After')
+
+        if attempt >= retries:
+            raise error
+
+        await asyncio.sleep(retry_delay(attempt, backoff, max_backoff,
+                                         retry_after))
+
+async def _request(url, method, body, headers, timeout):
+    """
+    Send an HTTP/1.1 request over a new connection and return the tuple
+    (status, reason, headers, body) of the response.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ValueError("unsupported URL: %s" % url)
+
+    https = parts.scheme == 'https'
+    port  = parts.port or (443 if https else 80)
+    path  = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query,
+                                     ''))
+
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(
+        parts.hostname, port, ssl=ssl.create_default_context() if https
+                                  else None), timeout)
+
+    try:
+        head = ["%s %s HTTP/1.1" % (method, path),
+                "Host: %s" % parts.netloc,
+                "Connection: close"]
+        head.extend("%s: %s" % item for item in headers.items())
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+        # Blocks are read from the disk on the executor, one at a time.
+        loop   = asyncio.get_running_loop()
+        blocks = iter(body)
+        while True:
+            block = await loop.run_in_executor(None, next, blocks, None)
+            if block is None:
+                break
+
+            writer.write(block)
+            await asyncio.wait_for(writer.drain(), timeout)
+
+        return await asyncio.wait_for(_read_response(reader), timeout)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+async def _read_response(reader):
+    """Read an HTTP/1.1 response from the given stream reader."""
+    line  = await reader.readline()
+    parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or \
+       not parts[1].isdigit():
+        raise http.client.BadStatusLine(line)
+
+    status = int(parts[1])
+    reason = parts[2] if len(parts) > 2 else ""
+
+    head = b""
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise http.client.IncompleteRead(head)
+        if line in (b"\r\n", b"\n"):
+            break
+        head += line
+
+    headers = http.client.parse_headers(io.BytesIO(head + b"\r\n"))
+
+    if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+        data = b""
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                break
+            data += await reader.readexactly(size)
+            await reader.readline()
+    elif headers.get('Content-Length') is not None:
+        data = await reader.readexactly(int(headers['Content-Length']))
+    else:
+        data = await reader.read()
+
+    return status, reason, headers, data
+
+
+if __name__ == '__main__':
+    ##################
+    # RUN UNIT TESTS #
+    import http.server
+    import tempfile
+    import unittest
+
+    from py3bencode import bencode
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """Stand-in for the API, failing with the statuses in faults."""
+        bodies = []
+        faults = []
+
+        def do_POST(self):
+            self.bodies.append(self.rfile.read(
+                int(self.headers['Content-Length'])))
+
+            status = self.faults.pop(0) if self.faults else 200
+            self.send_response(status)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b"2\r\nok\r\n0\r\n\r\n")
+
+        def log_message(self, *args):
+            pass
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            for index in range(3):
+                with open(os.path.join(self.tmp.name, "%d" % index),
+                          "wb") as fh:
+                    fh.write(os.urandom(300000))
+
+        def tearDown(self):
+            self.tmp.cleanup()
+
+        def test_build(self):
+            output = os.path.join(self.tmp.name, "x.torrent")
+
+            async def main():
+                build  = build_torrent(self.tmp.name, output,
+                                       piece_length=16384, read_size=65536)
+                events = [event async for event in build]
+                return events, await build
+
+            events, metainfo = asyncio.run(main())
+
+            self.assertEqual((900000, 900000), events[-1])
+            self.assertEqual(sorted(events), events)
+            self.assertEqual(16384, metainfo['info']['piece length'])
+            with open(output, "rb") as fh:
+                self.assertEqual(bencode(metainfo), fh.read())
+
+        def test_build_concurrently(self):
+            async def main():
+                builds = [build_torrent(self.tmp.name, piece_length=length)
+                          for length in (16384, 32768, 65536)]
+                return await asyncio.gather(*builds)
+
+            results = asyncio.run(main())
+            self.assertEqual([16384, 32768, 65536],
+                             [r['info']['piece length'] for r in results])
+
+        def test_cancel(self):
+            async def main():
+                build = build_torrent(self.tmp.name, piece_length=16384,
+                                      read_size=16384)
+                async for done, total in build:
+                    build.cancel()
+                    break
+                with self.assertRaises(asyncio.CancelledError):
+                    await build
+
+            asyncio.run(main())
+
+        def test_upload(self):
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                     Handler)
+            threading.Thread(target=server.serve_forever,
+                             daemon=True).start()
+            url = 'http://127.0.0.1:%d/entry' % server.server_port
+
+            async def main():
+                Handler.faults[:] = [503, 400]
+                with self.assertRaises(HTTPError) as context:
+                    await upload(b"x", {}, url, backoff=0.01)
+                self.assertEqual(400, context.exception.code)
+
+                Handler.faults[:] = [500]
+                path = os.path.join(self.tmp.name, "0")
+                return await asyncio.gather(*[
+                    upload(path, {'name': i}, url, base64=False,
+                           backoff=0.01) for i in range(4)])
+
+            try:
+                self.assertEqual([b"ok"] * 4, asyncio.run(main()))
+            finally:
+                server.shutdown()
+                server.server_close()
+
+            self.assertEqual(2 + 5, len(Handler.bodies))
+            with open(os.path.join(self.tmp.name, "0"), "rb") as fh:
+                self.assertIn(fh.read(), Handler.bodies[-1])
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Client for uploading torrents to the Academic Torrents API.
+
+Licensed according to GPL v3.
+"""
+
+import http.client
+import io
+import itertools
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+from base64 import b64encode
+from urllib.error import HTTPError
+
+from py3bencode import bencode
+from py3createtorrent import RateLimiter
+
+__all__ = ['APIClient', 'MultipartBody', 'retry_delay', 'upload_torrent']
+
+# The API entry point for new torrents.
+API_URL = 'https://academictorrents.com/apiv2/entry'
+
+# Size of the blocks in which the torrent is sent, in bytes. A multiple of
+# 3, so that the blocks can be base64-encoded one by one.
+CHUNK_SIZE = 3 * 2**16
+
+# Responses with these statuses are temporary failures, worth retrying.
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+class MultipartBody(object):
+    """
+    A multipart/form-data request body, which is generated while it is
+    sent instead of being built in memory.
+
+    The body consists of a text part for each of the form fields, followed
+    by the torrent. The torrent is read from its file in blocks of
+    CHUNK_SIZE bytes, or sliced from bencoded data in memory. By default
+    it is sent base64-encoded as the value of a text field, like the API
+    expects it. With base64=False it is sent as a file instead.
+
+    Iterating over the body yields its blocks. It can be iterated over more
+    than once (e.g. when a request is redirected), and its length is known
+    up front, so it is sent with a Content-Length.
+    """
+    def __init__(self, fields, file_field, torrent, filename='file.torrent',
+                 base64=True, boundary=None):
+        """
+        @param fields:     dictionary of the form fields (str or int values).
+        @param file_field: the name of the field of the torrent.
+        @param torrent:    the path of the torrent file, its bencoded data
+                           (bytes-like) or its metainfo dictionary.
+        @param filename:   the name of the torrent, if sent as a file.
+        """
+        if isinstance(torrent, dict):
+            torrent = bencode(torrent)
+
+        self.torrent  = torrent
+        self.base64   = base64
+        self.boundary = boundary or uuid.uuid4().hex
+
+        self._head = b"".join(self._part_header(name) +
+                              str(value).encode("utf-8") + b"\r\n"
+                              for name, value in fields.items())
+        self._head += self._part_header(file_field, None if base64
+                                        else filename)
+        self._tail = ("\r\n--%s--\r\n" % self.boundary).encode("ascii")
+
+    @property
+    def content_type(self):
+        return "multipart/form-data; boundary=%s" % self.boundary
+
+    def _part_header(self, name, filename=None):
+        """Return the boundary and headers of a part of the body."""
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' \
+                 % (self.boundary, _quote(name))
+
+        if filename is not None:
+            header += '; filename="%s"\r\nContent-Type: ' \
+                      'application/x-bittorrent' % _quote(filename)
+
+        return (header + "\r\n\r\n").encode("utf-8")
+
+    def _torrent_size(self):
+        if isinstance(self.torrent, str):
+            return os.path.getsize(self.torrent)
+
+        return memoryview(self.torrent).nbytes
+
+    def _torrent_chunks(self):
+        """Yield the torrent in blocks of (up to) CHUNK_SIZE bytes."""
+        if isinstance(self.torrent, str):
+            with open(self.torrent, "rb") as fh:
+                while True:
+                    chunk = fh.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+        else:
+            data = memoryview(self.torrent).cast('B')
+            for start in range(0, len(data), CHUNK_SIZE):
+                yield data[start:start + CHUNK_SIZE]
+
+    def __len__(self):
+        size = self._torrent_size()
+        if self.base64:
+            size = (size + 2) // 3 * 4
+
+        return len(self._head) + size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+
+        for chunk in self._torrent_chunks():
+            yield b64encode(chunk) if self.base64 else chunk
+
+        yield self._tail
+
+def retry_delay(attempt, backoff, max_backoff, retry_after=None):
+    """
+    Return the delay in seconds before the given retry (counting from 0):
+    the Retry-After value sent by the server, if any, otherwise a random
+    delay of up to backoff * 2**attempt seconds. Either is limited to
+    max_backoff seconds.
+    """
+    try:
+        return min(max_backoff, float(retry_after))
+    except (TypeError, ValueError):
+        pass
+
+    return random.uniform(0, min(max_backoff, backoff * 2**attempt))
+
+def _quote(name):
+    """Escape a field or file name for the Content-Disposition header."""
+    return name.replace('\\', '\\\\').replace('"', '\\"') \
+               .replace('\r', '%0D').replace('\n', '%0A')
+
+class APIClient(object):
+    """
+    Client of the API, keeping its connections to the server alive.
+
+    Up to connections requests are sent at a time (from several threads),
+    over connections which are reused for the following requests, saving
+    a TCP and TLS handshake each.
+
+    Requests failing with a connection error, a timeout or one of
+    RETRY_STATUSES are sent again up to retries times, after a random delay
+    of up to backoff * 2**attempt seconds (at most max_backoff seconds, or
+    as long as the server asks for with Retry-After). Note that a retried
+    upload may have reached the server before the connection failed.
+
+    With rate set, at most rate requests per second are sent.
+    """
+    def __init__(self, url=API_URL, connections=2, retries=3, backoff=1.0,
+                 max_backoff=60.0, timeout=60, rate=None):
+        self.url         = url
+        self.retries     = retries
+        self.backoff     = backoff
+        self.max_backoff = max_backoff
+        self.timeout     = timeout
+
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'https':
+            self._connection_class = http.client.HTTPSConnection
+        elif parts.scheme == 'http':
+            self._connection_class = http.client.HTTPConnection
+        else:
+            raise ValueError("unsupported URL: %s" % url)
+
+        self._host = parts.netloc
+        self._path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                              parts.query, ''))
+
+        self._limiter = RateLimiter(rate) if rate else None
+        self._slots   = threading.BoundedSemaphore(connections)
+        self._lock    = threading.Lock()
+        self._idle    = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            connection.close()
+
+    def upload_torrent(self, torrent, fields, file_field='file', base64=True):
+        """
+        Upload a torrent along with the given form fields and return the
+        body of the response.
+
+        The torrent is given as path, bencoded data or metainfo dictionary
+        (see MultipartBody). Only one block of it is held in memory at a
+        time.
+
+        @raise HTTPError: if the server responds with an error.
+        """
+        filename = os.path.basename(torrent) if isinstance(torrent, str) \
+                   else 'file.torrent'
+        body = MultipartBody(fields, file_field, torrent, filename, base64)
+
+        return self.request('POST', body, {
+            'Content-Type':   body.content_type,
+            'Content-Length': str(len(body)),
+        })
+
+    def request(self, method, body=None, headers={}):
+        """
+        Send a request to the API (retrying it if necessary) and return the
+        body of the response.
+
+        The body must be bytes or an iterable that can be iterated over
+        once per attempt (like MultipartBody).
+
+        @raise HTTPError: if the server responds with an error.
+        @raise OSError:   if the server cannot be reached.
+        """
+        for attempt in itertools.count():
+            if self._limiter is not None:
+                self._limiter.consume(1)
+
+            retry_after = None
+            try:
+                status, reason, response_headers, data = \
+                    self._send(method, body, headers)
+            except (OSError, http.client.HTTPException) as exc:
+                error = exc
+            else:
+                if status < 300:
+                    return data
+
+                error = HTTPError(self.url, status, reason, response_headers,
+                                  io.BytesIO(data))
+                if status not in RETRY_STATUSES:
+                    raise error
+
+                retry_after = response_headers.get('Retry-After')
+
+            if attempt >= self.retries:
+                raise error
+
+            time.sleep(self._delay(attempt, retry_after))
+
+    def _delay(self, attempt, retry_after=None):
+        """Return the delay before the given retry (counting from 0)."""
+        return retry_delay(attempt, self.backoff, self.max_backoff,
+                            retry_after)
+
+    def _send(self, method, body, headers):
+        """
+        Send a request over an idle or new connection and return the tuple
+        (status, reason, headers, body) of the response.
+        """
+        with self._slots:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+
+            # The server may have closed an idle connection in the meantime,
+            # in which case the request is sent again on a new one.
+            if connection is not None:
+                try:
+                    return self._exchange(connection, method, body, headers)
+                except (ConnectionError, http.client.RemoteDisconnected):
+                    pass
+
+            connection = self._connection_class(self._host,
+                                                timeout=self.timeout)
+            return self._exchange(connection, method, body, headers)
+
+    def _exchange(self, connection, method, body, headers):
+        try:
+            connection.request(method, self._path, body, headers)
+            response = connection.getresponse()
+            data     = response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            with self._lock:
+                self._idle.append(connection)
+
+        return response.status, response.reason, response.headers, data
+
+def upload_torrent(torrent, fields, url=API_URL, file_field='file',
+                   base64=True, **options):
+    """
+    Upload a torrent with a new APIClient for the given URL and return the
+    body of the response (see APIClient.upload_torrent()).
+
+    Further keyword arguments (e.g. retries) are passed on to APIClient.
+    """
+    with APIClient(url, connections=1, **options) as client:
+        return client.upload_torrent(torrent, fields, file_field, base64)
+
+if __name__ == '__main__':
+    ##################
+    # RUN UNIT TESTS #
+    import email.parser
+    import http.server
+    import socket
+    import tempfile
+    import unittest
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        Stand-in for the API, storing the requests it receives.
+
+        The responses are taken from the list faults first, each either a
+        status, 'drop' (closing the connection without a response) or a
+        delay in seconds (float) before the response.
+        """
+        protocol_version = 'HTTP/1.1'
+
+        requests    = []
+        connections = set()
+        faults      = []
+
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            body   = self.rfile.read(length)
+            self.requests.append((self.headers, body))
+            self.connections.add(self.client_address)
+
+            fault = self.faults.pop(0) if self.faults else 200
+            if fault == 'drop':
+                self.close_connection = True
+                return
+            if isinstance(fault, float):
+                time.sleep(fault)
+                fault = 200
+
+            self.send_response(fault)
+            if fault == 429:
+                self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok' if fault == 200 else b'no')
+
+        def log_message(self, *args):
+            pass
+
+    class Test(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                         Handler)
+            cls.server.daemon_threads = True
+            cls.url    = 'http://127.0.0.1:%d/entry' % cls.server.server_port
+            threading.Thread(target=cls.server.serve_forever,
+                             daemon=True).start()
+
+        @classmethod
+        def tearDownClass(cls):
+            cls.server.shutdown()
+            cls.server.server_close()
+
+        def setUp(self):
+            Handler.requests.clear()
+            Handler.connections.clear()
+            Handler.faults[:] = []
+
+            self.client = APIClient(self.url, retries=3, backoff=0.01,
+                                    timeout=5)
+
+        def tearDown(self):
+            self.client.close()
+
+        def upload(self, torrent, **kwargs):
+            fields = {'uid': 'user', 'name': 'näme "x"', 'category': 6}
+            self.assertEqual(b'ok', upload_torrent(torrent, fields, self.url,
+                                                   **kwargs))
+
+            headers, body = Handler.requests[-1]
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + headers['Content-Type'].encode() +
+                b'\r\n\r\n' + body)
+            self.assertTrue(message.is_multipart())
+
+            parts = {part.get_param('name', header='content-disposition'):
+                     part.get_payload(decode=True)
+                     for part in message.get_payload()}
+            self.assertEqual('user', parts['uid'].decode())
+            self.assertEqual('6', parts['category'].decode())
+            self.assertEqual('näme "x"', parts['name'].decode())
+            return parts['file']
+
+        def test_file(self):
+            data = os.urandom(3 * CHUNK_SIZE + 1)
+            with tempfile.NamedTemporaryFile(suffix='.torrent') as fh:
+                fh.write(data)
+                fh.flush()
+
+                self.assertEqual(b64encode(data), self.upload(fh.name))
+                self.assertEqual(data, self.upload(fh.name, base64=False))
+
+        def test_in_memory(self):
+            metainfo = {'info': {'name': 'x', 'pieces': os.urandom(20)}}
+            self.assertEqual(b64encode(bencode(metainfo)),
+                             self.upload(metainfo))
+            self.assertEqual(bencode(metainfo),
+                             self.upload(bytearray(bencode(metainfo)),
+                                         base64=False))
+
+        def test_length(self):
+            for size in [0, 1, 2, 3, CHUNK_SIZE, CHUNK_SIZE + 2]:
+                for encode in [True, False]:
+                    body = MultipartBody({'a': 1}, 'file', b'x' * size,
+                                         base64=encode)
+                    self.assertEqual(len(body), len(b"".join(body)))
+
+        def test_keep_alive(self):
+            for _ in range(3):
+                self.assertEqual(b'ok', self.client.upload_torrent(b'x', {}))
+
+            self.assertEqual(3, len(Handler.requests))
+            self.assertEqual(1, len(Handler.connections))
+
+        def test_retry(self):
+            Handler.faults[:] = [503, 'drop', 429, 0.1]
+            self.assertEqual(b'ok', self.client.upload_torrent(b'x', {}))
+            self.assertEqual(4, len(Handler.requests))
+
+            # The body is sent again as a whole.
+            self.assertEqual(Handler.requests[0][1], Handler.requests[3][1])
+
+        def test_retries_exhausted(self):
+            Handler.faults[:] = [500] * 4
+            with self.assertRaises(HTTPError) as context:
+                self.client.upload_torrent(b'x', {})
+
+            self.assertEqual(500, context.exception.code)
+            self.assertEqual(b'no', context.exception.read())
+            self.assertEqual(4, len(Handler.requests))
+
+        def test_no_retry(self):
+            Handler.faults[:] = [403]
+            with self.assertRaises(HTTPError):
+                self.client.upload_torrent(b'x', {})
+
+            self.assertEqual(1, len(Handler.requests))
+
+        def test_timeout(self):
+            Handler.faults[:] = [1.0]
+            client = APIClient(self.url, retries=0, timeout=0.2)
+            with self.assertRaises(socket.timeout):
+                client.upload_torrent(b'x', {})
+
+        def test_stale_connection(self):
+            # A connection closed by the server while it was idle is
+            # replaced without counting as a retry.
+            client = APIClient(self.url, retries=0)
+            client.upload_torrent(b'x', {})
+            client._idle[0].sock.shutdown(socket.SHUT_RDWR)
+
+            self.assertEqual(b'ok', client.upload_torrent(b'x', {}))
+
+        def test_rate(self):
+            client = APIClient(self.url, rate=20)
+            start  = time.monotonic()
+            for _ in range(4):
+                client.upload_torrent(b'x', {})
+
+            self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+"""
+Batch upload of datasets to Academic Torrents, driven by a manifest.
+
+The manifest lists one dataset per line, either as JSON objects (.jsonl) or
+as CSV with a header row (.csv), with the fields path, name, authors,
+descr, category, tags and urllist. Only path is required.
+
+Licensed according to GPL v3.
+"""
+
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import optparse
+import os
+import re
+import sys
+import threading
+import time
+
+from urllib.error import HTTPError
+
+from atclient import API_URL, APIClient
+from py3createtorrent import write_bencoded
+from torrent import make_metainfo
+from torrentindex import TorrentIndex
+
+__all__ = ['BatchUploader', 'read_manifest']
+
+# The fields of the manifest and their defaults.
+FIELDS = {
+    'path':     None,
+    'name':     None,      # default: the name of the file or directory
+    'authors':  '',
+    'descr':    None,      # default: "@article{,title={<name>}}"
+    'category': 'dataset',
+    'tags':     '',
+    'urllist':  '',
+}
+
+CATEGORIES = {'dataset': 6, 'paper': 5}
+
+# The torrents are created like upload.py does.
+PIECE_LENGTH = 32768
+ANNOUNCE     = 'https://academictorrents.com/announce.php'
+COMMENT      = "Torrent created with " \
+               "https://github.com/AcademicTorrents/academictorrents_uploader"
+
+MIB = 2**20
+
+def read_manifest(path):
+    """
+    Read the manifest at the given path and return its entries as list of
+    dictionaries with all of FIELDS, defaults filled in.
+
+    Raise ValueError if an entry is invalid or lists the same path as an
+    earlier one.
+    """
+    with open(path, newline='', encoding='utf-8') as fh:
+        if path.lower().endswith('.csv'):
+            reader = csv.DictReader(fh)
+            rows   = [(reader.line_num, row) for row in reader]
+        else:
+            rows = []
+            for number, line in enumerate(fh, 1):
+                if line.strip():
+                    try:
+                        rows.append((number, json.loads(line)))
+                    except ValueError as exc:
+                        raise ValueError("line %d: %s" % (number, exc))
+
+    entries = []
+    paths   = {}
+    for number, row in rows:
+        if not isinstance(row, dict):
+            raise ValueError("line %d: expected an object" % number)
+
+        unknown = set(row) - set(FIELDS)
+        if unknown:
+            raise ValueError("line %d: unknown fields: %s"
+                             % (number, ", ".join(sorted(map(str, unknown)))))
+
+        if not row.get('path'):
+            raise ValueError("line %d: no path given" % number)
+
+        entry = dict(FIELDS)
+        entry.update((key, value) for key, value in row.items()
+                     if value not in (None, ''))
+
+        entry['path'] = os.path.normpath(entry['path'])
+
+        path = os.path.normcase(os.path.abspath(entry['path']))
+        if path in paths:
+            raise ValueError("line %d: the path is listed on line %d already"
+                             % (number, paths[path]))
+        paths[path] = number
+        if entry['name'] is None:
+            entry['name'] = os.path.basename(entry['path'])
+        if entry['descr'] is None:
+            entry['descr'] = "@article{,title={%s}}" % entry['name']
+
+        entry['category'] = str(entry['category']).lower()
+        if entry['category'] not in CATEGORIES:
+            raise ValueError("line %d: category must be either 'paper' or "
+                             "'dataset'" % number)
+
+        entries.append(entry)
+
+    return entries
+
+def _torrent_name(path, unique=True):
+    """
+    Return the file name of the torrent for the given file or directory:
+    "<name>.torrent" like upload.py, or "<name>-<hash>.torrent" unless the
+    name is unique within the manifest, where hash is derived from the
+    absolute path so the name stays the same when the manifest is edited.
+    """
+    name = os.path.basename(os.path.abspath(path))
+    if unique:
+        return name + ".torrent"
+
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8',
+                                                       'surrogateescape'))
+    return "%s-%s.torrent" % (name, digest.hexdigest()[:8])
+
+class _Job(object):
+    """State of one entry of the manifest."""
+    def __init__(self, number, entry, output_dir, unique=True):
+        self.number  = number
+        self.entry   = entry
+        self.torrent = os.path.join(output_dir, _torrent_name(entry['path'],
+                                                              unique))
+
+        # The jobs of the same device are hashed one after another.
+        try:
+            self.device = os.stat(entry['path']).st_dev
+        except OSError:
+            self.device = None
+
+        self.size        = 0
+        self.reused      = False
+        self.hash_time   = 0.0
+        self.upload_time = 0.0
+        self.error       = None
+
+class BatchUploader(object):
+    """
+    Create torrents for the entries of a manifest and upload them.
+
+    Up to hash_jobs torrents are created at a time, each hashed by workers
+    threads. Datasets on the same device are hashed one after another,
+    since they would only compete for the disk, while datasets on other
+    devices are hashed in parallel. Finished torrents are uploaded by up to
+    upload_jobs threads at a time, while the hashing goes on.
+
+    The uploads share the connections of an APIClient, which retries them
+    on temporary failures (see there for retries, timeout and rate).
+
+    The torrents are written to output_dir, named after their datasets
+    (see _torrent_name()). Existing torrents are reused if they still
+    match their data.
+    """
+    def __init__(self, entries, api_key, hash_jobs=1, upload_jobs=2,
+                 workers=1, url=API_URL, output_dir='.', out=sys.stdout,
+                 retries=3, timeout=60, rate=None):
+        matches = re.match("uid=(.*);pass=(.*)", api_key)
+        if matches is None:
+            raise ValueError("invalid API key")
+
+        self.uid, self.password = matches.groups()
+
+        # Datasets of the same name get torrents of different names.
+        names  = [os.path.normcase(os.path.basename(os.path.abspath(
+                      entry['path']))) for entry in entries]
+        counts = collections.Counter(names)
+
+        self.jobs        = [_Job(number, entry, output_dir,
+                                 counts[name] == 1)
+                            for number, (entry, name)
+                            in enumerate(zip(entries, names), 1)]
+        self.hash_jobs   = hash_jobs
+        self.upload_jobs = upload_jobs
+        self.workers     = workers
+        self.out         = out
+
+        self.client = APIClient(url, upload_jobs, retries, timeout=timeout,
+                                rate=rate)
+
+        self._lock    = threading.Condition()
+        self._pending = list(self.jobs)
+        self._busy    = set()
+
+    def log(self, job, message):
+        with self._lock:
+            print("[%d/%d] %s: %s" % (job.number, len(self.jobs),
+                                      job.entry['name'], message),
+                  file=self.out, flush=True)
+
+    def run(self):
+        """Process all jobs and return the number of failed ones."""
+        start = time.monotonic()
+
+        with concurrent.futures.ThreadPoolExecutor(self.upload_jobs) \
+             as uploads:
+            threads = [threading.Thread(target=self._hash_loop,
+                                        args=(uploads,))
+                       for _ in range(min(self.hash_jobs, len(self.jobs)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.client.close()
+        self._summary(time.monotonic() - start)
+        return sum(1 for job in self.jobs if job.error is not None)
+
+    def _next_job(self):
+        """
+        Return the next job whose device is not being hashed, waiting for
+        one if necessary, or None if there are no jobs left.
+        """
+        with self._lock:
+            while self._pending:
+                for job in self._pending:
+                    if job.device is None or job.device not in self._busy:
+                        self._pending.remove(job)
+                        self._busy.add(job.device)
+                        return job
+
+                self._lock.wait()
+
+            return None
+
+    def _hash_loop(self, uploads):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            try:
+                self._hash(job)
+            finally:
+                with self._lock:
+                    self._busy.discard(job.device)
+                    self._lock.notify_all()
+
+            if job.error is None:
+                uploads.submit(self._upload, job)
+
+    def _hash(self, job):
+        path = job.entry['path']
+
+        if os.path.exists(job.torrent) and \
+           TorrentIndex.matches_data(job.torrent, path):
+            try:
+                with TorrentIndex.open(job.torrent) as index:
+                    files = [index.file(i)
+                             for i in range(index.file_count())]
+            except Exception as exc:
+                job.error = "reading %s failed: %s" % (job.torrent, exc)
+                self.log(job, "FAILED, " + job.error)
+                return
+
+            job.size   = sum(file['length'] for file in files
+                             if 'p' not in file.get('attr', ''))
+            job.reused = True
+            self.log(job, "reusing %s (%.1f MiB)"
+                          % (job.torrent, job.size / MIB))
+            return
+
+        self.log(job, "hashing")
+        start = time.monotonic()
+
+        try:
+            metainfo = make_metainfo(path, self.workers,
+                                     piece_length=PIECE_LENGTH,
+                                     announce=ANNOUNCE, comment=COMMENT,
+                                     include_md5=False)
+            write_bencoded(job.torrent, metainfo)
+        except Exception as exc:
+            job.error = "hashing failed: %s" % exc
+            self.log(job, "FAILED, " + job.error)
+            return
+
+        info = metainfo['info']
+        job.size      = info['length'] if 'length' in info else \
+                        sum(file['length'] for file in info['files'])
+        job.hash_time = time.monotonic() - start
+
+        self.log(job, "hashed %.1f MiB in %.1f s (%.1f MiB/s)"
+                      % (job.size / MIB, job.hash_time,
+                         job.size / MIB / max(job.hash_time, 1e-6)))
+
+    def _upload(self, job):
+        entry  = job.entry
+        fields = {
+            'uid':      self.uid,
+            'pass':     self.password,
+            'name':     entry['name'],
+            'authors':  entry['authors'],
+            'descr':    entry['descr'],
+            'category': CATEGORIES[entry['category']],
+            'tags':     entry['tags'],
+            'urllist':  entry['urllist'],
+            'private':  'true',
+        }
+
+        self.log(job, "uploading")
+        start = time.monotonic()
+
+        try:
+            reply = self.client.upload_torrent(job.torrent, fields)
+        except HTTPError as exc:
+            job.error = "upload failed: %s: %r" % (exc, exc.read())
+        except Exception as exc:
+            job.error = "upload failed: %s" % exc
+        else:
+            job.upload_time = time.monotonic() - start
+            self.log(job, "uploaded in %.1f s: %s"
+                          % (job.upload_time,
+                             reply.decode('utf-8', 'replace').strip()))
+            return
+
+        self.log(job, "FAILED, " + job.error)
+
+    def _summary(self, elapsed):
+        failed = [job for job in self.jobs if job.error is not None]
+        size   = sum(job.size for job in self.jobs if not job.reused)
+        reused = sum(job.size for job in self.jobs if job.reused)
+
+        print("\n%d of %d datasets uploaded in %.1f s, %d failed."
+              % (len(self.jobs) - len(failed), len(self.jobs), elapsed,
+                 len(failed)), file=self.out)
+        print("Hashed %.1f MiB (%.1f MiB/s overall)."
+              % (size / MIB, size / MIB / max(elapsed, 1e-6)),
+              file=self.out)
+        if reused:
+            print("Reused the torrents of %.1f MiB." % (reused / MIB),
+                  file=self.out)
+
+        for job in failed:
+            print("  %s: %s" % (job.entry['path'], job.error), file=self.out)
+
+def main(argv):
+    # Validate the command line.
+    parser = optparse.OptionParser("%prog [options] <manifest>",
+                                   description="Create torrents for the "
+                                   "datasets listed in the manifest (.jsonl "
+                                   "or .csv) and upload them to Academic "
+                                   "Torrents.")
+
+    parser.add_option("-k", "--key-file", type="string", action="store",
+                      dest="key_file", default=os.path.join(
+                          os.path.dirname(os.path.abspath(__file__)), "key"),
+                      help="file containing the API key [default: %default]")
+
+    parser.add_option("-j", "--jobs", type="int", action="store",
+                      dest="jobs", default=2,
+                      help="number of datasets hashed at a time (one per "
+                           "device) [default: %default]")
+
+    parser.add_option("-u", "--upload-jobs", type="int", action="store",
+                      dest="upload_jobs", default=2,
+                      help="number of torrents uploaded at a time "
+                           "[default: %default]")
+
+    parser.add_option("-w", "--workers", type="int", action="store",
+                      dest="workers", default=None,
+                      help="number of threads hashing each dataset "
+                           "[default: CPUs / jobs]")
+
+    parser.add_option("-o", "--output-dir", type="string", action="store",
+                      dest="output_dir", default=".",
+                      help="directory of the torrents [default: %default]")
+
+    parser.add_option("--url", type="string", action="store",
+                      dest="url", default=API_URL,
+                      help="API entry point [default: %default]")
+
+    parser.add_option("--retries", type="int", action="store",
+                      dest="retries", default=3,
+                      help="number of times a failed upload is retried "
+                           "[default: %default]")
+
+    parser.add_option("--timeout", type="float", action="store",
+                      dest="timeout", default=60,
+                      help="timeout of the requests in seconds "
+                           "[default: %default]")
+
+    parser.add_option("--max-request-rate", type="float", action="store",
+                      dest="max_request_rate", default=None,
+                      help="maximum number of requests per second "
+                           "[default: unlimited]")
+
+    (options, args) = parser.parse_args(args = argv[1:])
+
+    if len(args) != 1:
+        parser.error("Invalid number of arguments given. Expected 1, "
+                     "received %d." % len(args))
+
+    if options.jobs < 1:
+        parser.error("Invalid number of jobs: '%d'" % options.jobs)
+
+    if options.upload_jobs < 1:
+        parser.error("Invalid number of upload jobs: '%d'"
+                     % options.upload_jobs)
+
+    if options.retries < 0:
+        parser.error("Invalid number of retries: '%d'" % options.retries)
+
+    if options.timeout <= 0:
+        parser.error("Invalid timeout: '%g'" % options.timeout)
+
+    if options.max_request_rate is not None and options.max_request_rate <= 0:
+        parser.error("Invalid request rate: '%g'" % options.max_request_rate)
+
+    if options.workers is None:
+        options.workers = max(1, (os.cpu_count() or 1) // options.jobs)
+    elif options.workers < 1:
+        parser.error("Invalid number of workers: '%d'" % options.workers)
+
+    try:
+        with open(options.key_file) as fh:
+            api_key = fh.read().strip()
+    except IOError as exc:
+        parser.error("Could not read the API key: %s" % exc)
+
+    try:
+        entries = read_manifest(args[0])
+    except (IOError, ValueError) as exc:
+        parser.error("Invalid manifest '%s': %s" % (args[0], exc))
+
+    try:
+        uploader = BatchUploader(entries, api_key, options.jobs,
+                                 options.upload_jobs, options.workers,
+                                 options.url, options.output_dir,
+                                 retries=options.retries,
+                                 timeout=options.timeout,
+                                 rate=options.max_request_rate)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    return 1 if uploader.run() else 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv))
+
+    ##################
+    # RUN UNIT TESTS #
+    import email.parser
+    import http.server
+    import io
+    import tempfile
+    import unittest
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        Stand-in for the API, storing the fields of the uploads it receives
+        and failing with the statuses in faults first.
+        """
+        protocol_version = 'HTTP/1.1'
+
+        uploads = []
+        faults  = []
+
+        def do_POST(self):
+            body    = self.rfile.read(int(self.headers['Content-Length']))
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode() +
+                b'\r\n\r\n' + body)
+            self.uploads.append({
+                part.get_param('name', header='content-disposition'):
+                part.get_payload(decode=True)
+                for part in message.get_payload()})
+
+            status = self.faults.pop(0) if self.faults else 200
+            self.send_response(status)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'ok' if status == 200 else b'no')
+
+        def log_message(self, *args):
+            pass
+
+    class Test(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                         Handler)
+            cls.server.daemon_threads = True
+            cls.url    = 'http://127.0.0.1:%d/entry' % cls.server.server_port
+            threading.Thread(target=cls.server.serve_forever,
+                             daemon=True).start()
+
+        @classmethod
+        def tearDownClass(cls):
+            cls.server.shutdown()
+            cls.server.server_close()
+
+        def setUp(self):
+            Handler.uploads.clear()
+            Handler.faults[:] = []
+
+            self.tmp = tempfile.TemporaryDirectory()
+            self.dir = self.tmp.name
+
+            # Two datasets of the same name and a single file.
+            for name in ["a/data/1", "a/data/2", "b/data/1", "file.bin"]:
+                path = os.path.join(self.dir, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "wb") as fh:
+                    fh.write(os.urandom(50000))
+
+            os.mkdir(os.path.join(self.dir, "torrents"))
+
+        def tearDown(self):
+            self.tmp.cleanup()
+
+        def manifest(self, name, text):
+            path = os.path.join(self.dir, name)
+            with open(path, "w", encoding='utf-8') as fh:
+                fh.write(text)
+            return path
+
+        def test_read_manifest(self):
+            path = self.manifest("m.jsonl",
+                                 '{"path": "x/y/", "tags": "a,b"}\n\n'
+                                 '{"path": "z", "name": "Z", '
+                                 '"category": "Paper"}\n')
+            self.assertEqual([
+                dict(FIELDS, path='x/y', name='y', tags='a,b',
+                     descr='@article{,title={y}}'),
+                dict(FIELDS, path='z', name='Z', category='paper',
+                     descr='@article{,title={Z}}')],
+                read_manifest(path))
+
+            path = self.manifest("m.csv", 'path,name,authors\n'
+                                          'x,,Someone\n'
+                                          'z,Z,\n')
+            entries = read_manifest(path)
+            self.assertEqual(['x', 'Z'], [e['name'] for e in entries])
+            self.assertEqual(['Someone', ''], [e['authors'] for e in entries])
+
+            for text, error in [('{"path": "x"}\n{"size": 1}\n',
+                                 "line 2: unknown fields: size"),
+                                ('{"name": "x"}\n', "line 1: no path"),
+                                ('{"path": "x", "category": "music"}\n',
+                                 "line 1: category"),
+                                ('["x"]\n', "line 1: expected an object"),
+                                ('{"path": \n', "line 1: "),
+                                ('{"path": "x/"}\n{"path": "./x"}\n',
+                                 "line 2: the path is listed on line 1")]:
+                with self.assertRaisesRegex(ValueError, error):
+                    read_manifest(self.manifest("bad.jsonl", text))
+
+        def run_uploader(self, entries, **options):
+            out      = io.StringIO()
+            uploader = BatchUploader(entries, "uid=me;pass=secret",
+                                     url=self.url, out=out,
+                                     output_dir=os.path.join(self.dir,
+                                                             "torrents"),
+                                     timeout=5, **options)
+            uploader.client.backoff = 0.01
+            return uploader, uploader.run(), out.getvalue()
+
+        def test_upload(self):
+            path = self.manifest("m.jsonl", "".join(
+                '{"path": "%s", "name": "%s"}\n'
+                % (os.path.join(self.dir, name), title)
+                for name, title in [("a/data", "A"), ("b/data", "B"),
+                                    ("file.bin", "F")]))
+            entries = read_manifest(path)
+
+            uploader, failed, out = self.run_uploader(entries, hash_jobs=2)
+            self.assertEqual(0, failed, out)
+            sizes = [job.size for job in uploader.jobs]
+            self.assertTrue(all(sizes), sizes)
+
+            # The datasets of the same name have torrents of their own.
+            torrents = [job.torrent for job in uploader.jobs]
+            self.assertEqual(3, len(set(torrents)))
+            self.assertEqual("file.bin.torrent", os.path.basename(torrents[2]))
+            for job in uploader.jobs:
+                self.assertTrue(TorrentIndex.matches_data(job.torrent,
+                                                          job.entry['path']))
+
+            fields = sorted(Handler.uploads, key=lambda f: f['name'])
+            self.assertEqual([b'A', b'B', b'F'], [f['name'] for f in fields])
+            self.assertEqual(b'me', fields[0]['uid'])
+            self.assertEqual(b'6', fields[0]['category'])
+
+            # The torrents are reused the next time, a failed upload counts.
+            Handler.faults[:] = [400]
+            uploader, failed, out = self.run_uploader(entries, retries=0)
+            self.assertEqual(1, failed)
+            self.assertEqual(3, out.count("reusing"))
+            self.assertEqual(sizes, [job.size for job in uploader.jobs])
+            self.assertIn("Reused the torrents of", out)
+            self.assertIn("1 failed", out)
+
+        def test_invalid_key(self):
+            with self.assertRaises(ValueError):
+                BatchUploader([], "secret")
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Download a file and hash it for a torrent in the same pass, so the torrent
+is ready as soon as the download is complete.
+
+Licensed according to GPL v3.
+"""
+
+import http.client
+import optparse
+import os
+import queue
+import re
+import sys
+import time
+import urllib.parse
+
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from py3createtorrent import (_Block, _StreamReader, calculate_piece_length,
+                             HASH_BATCH_SIZE, KIB, MIB, PieceHasher, VERSION,
+                             write_bencoded)
+
+__all__ = ['download_file']
+
+# Size of the blocks the response is read in, in bytes.
+DOWNLOAD_READ_SIZE = 1 * MIB
+
+def download_file(url, path, piece_length=None, workers=1,
+                  read_size=DOWNLOAD_READ_SIZE, resume=True, timeout=60,
+                  progress=None):
+    """
+    Download the file at the given URL to the given path and return the
+    info dictionary of a torrent for it (see create_single_file_info()).
+
+    Every block of the response is written to the file and fed to the piece
+    hasher from the same buffer, so the file is never read back. The pieces
+    are hashed by the given number of threads.
+
+    With resume=True, an existing file is continued with a range request.
+    The hasher catches up by reading the bytes already on disk (while the
+    response waits), then carries on with the downloaded ones. If the
+    server does not support ranges, the file is downloaded again from the
+    start.
+
+    Unless given, the piece length is chosen according to the size of the
+    file, which the server must announce then.
+
+    progress, if given, is called as progress(done, total) after every
+    block, where total is None if the size of the file is unknown.
+
+    Raise ValueError or http.client.IncompleteRead if the download is
+    incomplete, in which case it can be resumed later.
+    """
+    offset = os.path.getsize(path) if resume and os.path.exists(path) else 0
+
+    request = Request(url)
+    if offset > 0:
+        request.add_header('Range', 'bytes=%d-' % offset)
+
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as exc:
+        # The range is not satisfiable if the file is complete already.
+        match = re.match(r"bytes \*/(\d+)$",
+                         exc.headers.get('Content-Range', ''))
+        if offset == 0 or exc.code != 416 or match is None or \
+           int(match.group(1)) != offset:
+            raise
+
+        response = None
+        length   = offset
+
+    try:
+        if response is not None:
+            if response.status == 206:
+                match = re.match(r"bytes (\d+)-",
+                                 response.headers.get('Content-Range', ''))
+                if match is None or int(match.group(1)) != offset:
+                    raise ValueError("unexpected range in response: %s"
+                                     % response.headers['Content-Range'])
+            else:
+                # The server sends the whole file.
+                offset = 0
+
+            length = response.headers.get('Content-Length')
+            if length is not None:
+                length = offset + int(length)
+
+        if piece_length is None:
+            if not length:
+                raise ValueError("the size of the file is unknown, the "
+                                 "piece length must be given")
+            piece_length = calculate_piece_length(length)
+
+        # Enough blocks for the current piece and the one being read and,
+        # in threaded mode, the batches waiting for a worker.
+        buffers = 2 + -(-piece_length // read_size)
+        if workers > 1:
+            buffers += -(-2 * workers * max(piece_length, HASH_BATCH_SIZE)
+                         // read_size)
+
+        done = 0
+
+        with PieceHasher(piece_length, length or 0, workers) as hasher, \
+             open(path, "r+b" if offset > 0 else "wb") as fh:
+
+            # Catch up with the bytes on disk.
+            if offset > 0:
+                with _StreamReader(read_size, buffers, None) as reader:
+                    for view, owner in reader.read(path, 0, offset):
+                        if view is None:
+                            hasher.update_zeros(owner)
+                            done += owner
+                        else:
+                            hasher.update(view, owner)
+                            done += len(view)
+
+                        if progress is not None:
+                            progress(done, length)
+
+                fh.seek(offset)
+                fh.truncate()
+
+            # Download the rest.
+            pool = queue.Queue()
+            for _ in range(buffers):
+                pool.put(_Block(pool, read_size))
+
+            while response is not None:
+                block = pool.get()
+                block.acquire()
+                try:
+                    count = response.readinto(block.view)
+                    if count == 0:
+                        break
+
+                    fh.write(block.view[:count])
+                    hasher.update(block.view[:count], block)
+                finally:
+                    block.release()
+
+                done += count
+                if progress is not None:
+                    progress(done, length)
+
+            if length is not None and done != length:
+                raise ValueError("incomplete download: %d of %d bytes"
+                                 % (done, length))
+
+            if done == 0:
+                raise ValueError("empty file")
+
+            pieces = hasher.finish()
+    finally:
+        if response is not None:
+            response.close()
+
+    return {
+           'pieces':       pieces,
+           'name':         os.path.basename(path),
+           'length':       done,
+           'piece length': piece_length,
+           }
+
+def main(argv):
+    # Validate the command line.
+    parser = optparse.OptionParser("%prog [options] <url> [<file>]",
+                                   description="Download the file at the "
+                                   "URL (continuing a previous download of "
+                                   "it) and create a torrent for it at the "
+                                   "same time.")
+
+    parser.add_option("-p", "--piece-length", type="int", action="store",
+                      dest="piece_length", default=0,
+                      help="piece size in KiB. 0 = automatic selection "
+                           "(default).")
+
+    parser.add_option("-c", "--comment", type="string", action="store",
+                      dest="comment", default=None,
+                      help="include comment")
+
+    parser.add_option("-o", "--output", type="string", action="store",
+                      dest="output", default=None,
+                      help="path of the torrent [default: <file>.torrent]")
+
+    parser.add_option("-w", "--workers", type="int", action="store",
+                      dest="workers", default=1,
+                      help="number of threads hashing pieces "
+                           "[default: %default]")
+
+    parser.add_option("--no-resume", action="store_false",
+                      dest="resume", default=True,
+                      help="download the file again from the start")
+
+    parser.add_option("--timeout", type="float", action="store",
+                      dest="timeout", default=60,
+                      help="timeout of the connection in seconds "
+                           "[default: %default]")
+
+    (options, args) = parser.parse_args(args = argv[1:])
+
+    if len(args) not in (1, 2):
+        parser.error("Invalid number of arguments given. Expected 1 or 2, "
+                     "received %d." % len(args))
+
+    url = args[0]
+    if len(args) == 2:
+        path = args[1]
+    else:
+        path = urllib.parse.unquote(os.path.basename(
+                   urllib.parse.urlsplit(url).path))
+        if not path:
+            parser.error("Cannot derive a file name from the URL, please "
+                         "give one.")
+
+    if options.piece_length < 0:
+        parser.error("Invalid piece size: '%d'" % options.piece_length)
+
+    if options.workers < 1:
+        parser.error("Invalid number of workers: '%d'" % options.workers)
+
+    # Report the progress every few seconds.
+    start  = time.monotonic()
+    report = [start]
+
+    def progress(done, total):
+        now = time.monotonic()
+        if now < report[0] + 5:
+            return
+
+        report[0] = now
+        print("%.1f MiB%s (%.1f MiB/s)"
+              % (done / MIB, " of %.1f MiB" % (total / MIB) if total else "",
+                 done / MIB / (now - start)), file=sys.stderr)
+
+    try:
+        info = download_file(url, path, options.piece_length * KIB or None,
+                             options.workers, resume=options.resume,
+                             timeout=options.timeout, progress=progress)
+    except (IOError, ValueError, http.client.HTTPException) as exc:
+        print("Error: %s" % exc, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 1
+
+    # Construct the metainfo like py3createtorrent does.
+    metainfo = {
+                'info':          info,
+                'announce':      'http://academictorrents.com/announce.php',
+                'creation date': int(time.time()),
+                'created by':    'py3createtorrent v%s' % VERSION,
+                }
+
+    if options.comment:
+        metainfo['comment'] = options.comment
+
+    output_path = options.output or os.path.basename(path) + ".torrent"
+
+    try:
+        write_bencoded(output_path, metainfo)
+    except IOError as exc:
+        print("IOError: " + str(exc), file=sys.stderr)
+        print("Could not write the torrent file.", file=sys.stderr)
+        return 1
+
+    print("Downloaded %s and created %s." % (path, output_path))
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv))
+
+    ##################
+    # RUN UNIT TESTS #
+    import http.server
+    import tempfile
+    import threading
+    import unittest
+
+    from py3createtorrent import create_single_file_info
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        """
+        Serves data with support for ranges. The connection is closed after
+        cut bytes of the response, and ranges are ignored unless ranges.
+        """
+        data   = b""
+        cut    = None
+        ranges = True
+
+        def do_GET(self):
+            start = 0
+            match = re.match(r"bytes=(\d+)-$", self.headers.get('Range', ''))
+
+            if match is not None and self.ranges:
+                start = int(match.group(1))
+                if start >= len(self.data):
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d'
+                                     % len(self.data))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d'
+                                 % (start, len(self.data) - 1,
+                                    len(self.data)))
+            else:
+                self.send_response(200)
+
+            self.send_header('Content-Length', str(len(self.data) - start))
+            self.end_headers()
+            self.wfile.write(self.data[start:self.cut])
+
+        def log_message(self, *args):
+            pass
+
+    class Test(unittest.TestCase):
+        @classmethod
+        def setUpClass(cls):
+            cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                         Handler)
+            cls.url    = 'http://127.0.0.1:%d/data.bin' % cls.server.server_port
+            threading.Thread(target=cls.server.serve_forever,
+                             daemon=True).start()
+
+        @classmethod
+        def tearDownClass(cls):
+            cls.server.shutdown()
+            cls.server.server_close()
+
+        def setUp(self):
+            self.tmp  = tempfile.TemporaryDirectory()
+            self.path = os.path.join(self.tmp.name, "data.bin")
+
+            Handler.data   = os.urandom(5 * 65536 + 1234)
+            Handler.cut    = None
+            Handler.ranges = True
+
+        def tearDown(self):
+            self.tmp.cleanup()
+
+        def check(self, info, piece_length=65536):
+            with open(self.path, "rb") as fh:
+                self.assertEqual(Handler.data, fh.read())
+
+            expected = create_single_file_info(self.path, piece_length, False)
+            self.assertEqual(expected['pieces'], info['pieces'])
+            self.assertEqual(len(Handler.data), info['length'])
+            self.assertEqual(piece_length, info['piece length'])
+
+        def interrupt(self, cut):
+            Handler.cut = cut
+            with self.assertRaises((ValueError, http.client.IncompleteRead)):
+                download_file(self.url, self.path, 65536, read_size=4096)
+            Handler.cut = None
+
+        def test_download(self):
+            for workers in [1, 3]:
+                self.check(download_file(self.url, self.path, 65536,
+                                         workers, read_size=50000,
+                                         resume=False))
+
+        def test_resume(self):
+            self.interrupt(100000)
+
+            events = []
+            info   = download_file(self.url, self.path, 65536,
+                                   progress=lambda *args: events.append(args))
+            self.check(info)
+            self.assertEqual((len(Handler.data), len(Handler.data)),
+                             events[-1])
+
+            # There is nothing left to download.
+            self.check(download_file(self.url, self.path, 65536))
+
+        def test_no_ranges(self):
+            self.interrupt(100000)
+
+            Handler.ranges = False
+            self.check(download_file(self.url, self.path, 65536))
+
+        def test_piece_length(self):
+            info = download_file(self.url, self.path)
+            self.check(info, calculate_piece_length(len(Handler.data)))
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -4,9 +4,7 @@ from PyQt5 import QtGui, QtCore, QtWidgets, uic
 from torrent import make_torrent
 import os.path
 import re
-from base64 import b64encode
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+from atclient import upload_torrent
 from urllib.error import HTTPError
 
 api_key_file = '.api_key.txt'
@@ -132,18 +130,14 @@ class ATUploaderGui(QtWidgets.QMainWindow):
             'category' : category,
             'tags' : self.ui.tags_field.text(),
             'urllist' : self.ui.backup_url_field.text(),
-            'file' : b64encode(open(my_torrent, 'rb').read())
         }
         
-        data = urlencode(post_params).encode('utf-8')
-        req = Request('http://academictorrents.com/api/paper', data)
-        
         try:
-            response = urlopen(req)
+            response = upload_torrent(my_torrent, post_params,
+                                      'http://academictorrents.com/api/paper')
         except HTTPError as e:
             print(e)
-            response = e
-            print(response.read())            
+            print(e.read())
         QtWidgets.QMessageBox.about(self, "Success", "You've uploaded!")
 
 if __name__ == "__main__":
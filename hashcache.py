@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of piece hashes for py3createtorrent.
+
+Licensed according to GPL v3.
+"""
+
+import sqlite3
+import time
+
+__all__ = ['HashCache']
+
+# Default upper limit for the total size of the cached hashes in bytes.
+MAX_SIZE = 1024 * 2**20
+
+class HashCache(object):
+    """
+    An SQLite database mapping file identities to the SHA-1 hashes of the
+    pieces lying completely within the file.
+
+    Keys are tuples (device, inode, size, mtime_ns, piece_length,
+    alignment), where alignment is the file's offset within the torrent
+    modulo the piece length. The hashes of the file's whole pieces only
+    depend on its content and on the alignment, so they can be reused as
+    long as the file is not modified.
+
+    Once the cached hashes exceed max_size bytes, the least recently used
+    entries are evicted: by put() down to nine tenths of max_size, so it
+    does not have to evict for every further file, and by close() down to
+    max_size.
+
+    Every put() is committed right away, so the database is never locked
+    for long and other processes can use it at the same time. The times
+    entries are used by get() are kept in memory and written along with
+    the next put(), evict() or close().
+    """
+    def __init__(self, path, max_size=MAX_SIZE):
+        self.path     = path
+        self.max_size = max_size
+
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("CREATE TABLE IF NOT EXISTS pieces ("
+                         "dev INTEGER, ino INTEGER, size INTEGER, "
+                         "mtime_ns INTEGER, piece_length INTEGER, "
+                         "alignment INTEGER, digests BLOB, md5sum TEXT, "
+                         "last_used REAL, PRIMARY KEY (dev, ino, size, "
+                         "mtime_ns, piece_length, alignment))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS pieces_last_used "
+                         "ON pieces (last_used)")
+        self._db.commit()
+
+        # Total size of the cached hashes, kept up to date by put().
+        self._size = self._total()
+
+        # Times of the get() hits not yet written, by key.
+        self._used = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, key):
+        """
+        Return a tuple (digests, md5sum) for the given key or None.
+
+        md5sum is None unless it was stored along with the digests.
+        """
+        row = self._db.execute("SELECT digests, md5sum FROM pieces WHERE "
+                               "dev=? AND ino=? AND size=? AND mtime_ns=? AND "
+                               "piece_length=? AND alignment=?",
+                               key).fetchone()
+        if row is None:
+            return None
+
+        # Updating the row would start a write transaction, locking the
+        # database until the next commit.
+        self._used[tuple(key)] = time.time()
+
+        return bytes(row[0]), row[1]
+
+    def put(self, key, digests, md5sum=None):
+        """Store the digests (and optionally the md5sum) for the given key."""
+        dev, ino, size, mtime_ns, piece_length, alignment = key
+
+        self._write_used()
+
+        # Older versions of the same file will never be used again, and the
+        # entry of the same key is replaced.
+        self._size -= self._db.execute(
+            "SELECT TOTAL(LENGTH(digests)) FROM pieces WHERE dev=? AND "
+            "ino=? AND (size!=? OR mtime_ns!=? OR (piece_length=? AND "
+            "alignment=?))", key).fetchone()[0]
+
+        self._db.execute("DELETE FROM pieces WHERE dev=? AND ino=? AND "
+                         "(size!=? OR mtime_ns!=?)",
+                         (dev, ino, size, mtime_ns))
+
+        self._db.execute("INSERT OR REPLACE INTO pieces VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         tuple(key) + (digests, md5sum, time.time()))
+        self._size += len(digests)
+
+        if self._size > self.max_size:
+            self.evict(self.max_size * 9 // 10)
+
+        self._db.commit()
+
+    def _write_used(self):
+        """Write the times of the get() hits (without committing)."""
+        if self._used:
+            self._db.executemany("UPDATE pieces SET last_used=? WHERE "
+                                 "dev=? AND ino=? AND size=? AND "
+                                 "mtime_ns=? AND piece_length=? AND "
+                                 "alignment=?",
+                                 [(used,) + key for key, used in
+                                  self._used.items()])
+            self._used.clear()
+
+    def _total(self):
+        """Return the total size of the cached hashes in the database."""
+        return self._db.execute("SELECT TOTAL(LENGTH(digests)) "
+                                "FROM pieces").fetchone()[0]
+
+    def evict(self, limit=None):
+        """
+        Evict the least recently used entries until the cached hashes take
+        up at most limit bytes (default: max_size).
+        """
+        if limit is None:
+            limit = self.max_size
+
+        self._write_used()
+
+        # Other processes may have changed the database as well.
+        size = self._total()
+
+        rows = self._db.execute("SELECT rowid, LENGTH(digests) FROM pieces "
+                                "ORDER BY last_used")
+
+        evicted = []
+        for rowid, length in rows:
+            if size <= limit:
+                break
+
+            evicted.append((rowid,))
+            size -= length
+
+        self._db.executemany("DELETE FROM pieces WHERE rowid=?", evicted)
+        self._db.commit()
+        self._size = size
+
+    def close(self):
+        """Evict entries if necessary and write all changes to disk."""
+        if self._db is None:
+            return
+
+        self.evict()
+        self._db.close()
+        self._db = None
+
+
+if __name__ == '__main__':
+    ##################
+    # RUN UNIT TESTS #
+    import os
+    import tempfile
+    import unittest
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp   = tempfile.TemporaryDirectory()
+            self.path  = os.path.join(self.tmp.name, "cache.db")
+            self.cache = HashCache(self.path, max_size=100)
+
+        def tearDown(self):
+            self.cache.close()
+            self.tmp.cleanup()
+
+        def put(self, ino, size=10, mtime_ns=1):
+            # Distinct times for the LRU order.
+            time.sleep(0.002)
+            self.cache.put((1, ino, size, mtime_ns, 16384, 0),
+                           bytes([ino]) * size, "md5-%d" % ino)
+
+        def get(self, ino, size=10, mtime_ns=1):
+            time.sleep(0.002)
+            return self.cache.get((1, ino, size, mtime_ns, 16384, 0))
+
+        def test_hit(self):
+            self.put(1)
+            self.assertEqual((b"\x01" * 10, "md5-1"), self.get(1))
+            self.assertEqual(b"\x01" * 10, self.get(1)[0])
+
+            # Other piece lengths and alignments are separate entries.
+            self.assertIsNone(self.cache.get((1, 1, 10, 1, 32768, 0)))
+            self.assertIsNone(self.cache.get((1, 1, 10, 1, 16384, 5)))
+
+        def test_persistent(self):
+            self.put(1)
+            self.cache.close()
+
+            self.cache = HashCache(self.path, max_size=100)
+            self.assertEqual((b"\x01" * 10, "md5-1"), self.get(1))
+
+        def test_modified(self):
+            self.put(1)
+            self.assertIsNone(self.get(1, size=11))
+            self.assertIsNone(self.get(1, mtime_ns=2))
+
+            # A new version of the file replaces the old one.
+            self.put(1, mtime_ns=2)
+            self.assertIsNone(self.get(1))
+            self.assertIsNotNone(self.get(1, mtime_ns=2))
+            self.assertEqual(10, self.cache._size)
+
+        def test_lru(self):
+            for ino in range(1, 11):
+                self.put(ino)
+            self.assertEqual(100, self.cache._size)
+
+            # Using 1 makes 2 the least recently used entry, which is evicted
+            # when going over the limit, down to nine tenths of it.
+            self.get(1)
+            self.put(11)
+
+            self.assertIsNone(self.get(2))
+            self.assertIsNone(self.get(3))
+            for ino in [1] + list(range(4, 12)):
+                self.assertIsNotNone(self.get(ino), ino)
+            self.assertEqual(90, self.cache._size)
+
+        def test_max_size(self):
+            for ino in range(1, 31):
+                self.put(ino, size=7)
+                self.assertLessEqual(self.cache._size, 100)
+
+            self.assertIsNotNone(self.get(30, size=7))
+            self.assertIsNone(self.get(1, size=7))
+
+            # close() evicts down to max_size, after a smaller limit.
+            self.cache.max_size = 50
+            self.cache.close()
+
+            self.cache = HashCache(self.path, max_size=50)
+            self.assertLessEqual(self.cache._size, 50)
+            self.assertIsNotNone(self.get(30, size=7))
+
+        def test_concurrent(self):
+            self.put(1)
+            self.get(1)
+
+            # Another process can write while the cache is open, and sees
+            # what has been put so far.
+            with HashCache(self.path, max_size=100) as other:
+                other._db.execute("PRAGMA busy_timeout = 0")
+                self.assertEqual((b"\x01" * 10, "md5-1"),
+                                 other.get((1, 1, 10, 1, 16384, 0)))
+                other.put((1, 2, 10, 1, 16384, 0), b"\x02" * 10)
+
+            self.assertEqual(b"\x02" * 10, self.get(2)[0])
+            self.put(3)
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -4,21 +4,39 @@ Copyright (C) 2010-2013 Robert Nitsch
 Licensed according to GPL v3.
 """
 
+import bisect
+import collections
+import concurrent.futures
 import datetime
+import errno
 import hashlib
+import itertools
 import math
+import mmap
 import optparse
 import os
+import queue
+import random
 import re
+import stat
 import sys
+import threading
 import time
 
-from py3bencode import bencode
+from hashcache import HashCache
+from py3bencode import _str, bdecode, bencode_to_file, DecodingException
 
 __all__ = ['calculate_piece_length',
+           'create_v2_info',
            'get_files_in_directory',
+           'get_update_prefix',
+           'hash_files',
+           'PieceHasher',
+           'RateLimiter',
            'sha1_20',
-           'split_path']
+           'split_path',
+           'write_bencoded',
+           'write_sha256sums']
 
 # #############
 # CONFIGURATION
@@ -34,6 +52,37 @@ VERSION =   '0.9.5'
 KIB = 2**10
 MIB = KIB * KIB
 
+# Number of bytes read from disk at once, independent of the piece length.
+READ_SIZE = 8 * MIB
+
+# Files of at least this size are memory-mapped instead of read.
+MMAP_THRESHOLD = 64 * MIB
+
+# Seconds between two checkpoints written to the journal by hash_files().
+CHECKPOINT_INTERVAL = 60
+
+# Format version of the journal.
+JOURNAL_VERSION = 2
+
+# Number of randomly chosen pieces of an existing torrent that are hashed
+# again before it is updated.
+UPDATE_SAMPLES = 8
+
+# Size of the blocks hashed into the leaves of the v2 merkle trees.
+BLOCK_SIZE = 16 * KIB
+
+# Number of files handed to a hashing process at once for v2 torrents.
+V2_CHUNKSIZE = 16
+
+# Minimum number of bytes handed to a hashing thread at once. Batching
+# small pieces keeps the overhead of the thread pool low.
+HASH_BATCH_SIZE = 1 * MIB
+
+# Files of up to SMALL_FILE_SIZE bytes are read ahead by PREFETCH_DEPTH
+# threads, unless configured otherwise.
+SMALL_FILE_SIZE = 1 * MIB
+PREFETCH_DEPTH  = 16
+
 
 def sha1_20(data):
     """Return the first 20 bytes of the given data's SHA-1 hash."""
@@ -41,7 +90,1628 @@ def sha1_20(data):
     m.update(data)
     return m.digest()[:20]
 
-def create_single_file_info(file, piece_length, include_md5=True):
+class PieceHasher(object):
+    """
+    Calculate the concatenated 20-byte-sha1-hashes of a stream of data.
+
+    The data is fed in order via update(). Every complete piece is hashed
+    right away or, if workers > 1, handed to a pool of threads. hashlib
+    releases the GIL while hashing, so the pool can keep several cores
+    busy while the caller keeps reading.
+
+    Each digest is written into its own slot of a preallocated buffer, thus
+    the result is the same no matter in which order the pieces finish.
+
+    Pieces are never assembled into a buffer of their own. The serial path
+    feeds the data straight into a running hash object, while the threaded
+    path hands memoryview slices of the caller's buffers to the workers.
+    Either way, pieces crossing the boundaries of the given data (e.g. at
+    the end of a file) do not cost any extra copies.
+    """
+    def __init__(self, piece_length, total_length=0, workers=1):
+        """
+        @param total_length: expected number of bytes, used to preallocate
+                             the pieces buffer. The buffer still grows if
+                             more data arrives.
+        @param workers:      number of hashing threads. 1 = hash in the
+                             calling thread.
+        """
+        if not isinstance(workers, int):
+            raise TypeError("workers must be instance of: int")
+
+        if workers < 1:
+            raise ValueError("workers must be at least 1 (given: %d)" % workers)
+
+        self.piece_length = piece_length
+        self.workers      = workers
+
+        # Concatenated 20byte sha1-hashes of all pieces.
+        self.pieces = bytearray(20 * -(-total_length // piece_length))
+
+        # Number of pieces handed out for hashing so far.
+        self._count = 0
+
+        # Number of bytes of the current, incomplete piece.
+        self._fill  = 0
+
+        # A buffer of zeros and the hash of a piece of zeros, see
+        # update_zeros().
+        self._zeros       = None
+        self._zero_digest = None
+
+        self._error = None
+
+        if workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+            # Limit the number of batches that wait in memory for a worker.
+            self._slots    = threading.BoundedSemaphore(2 * workers)
+
+            # Segments of the current piece and the owners of their memory.
+            self._segments = []
+            self._owners   = []
+        else:
+            self._executor = None
+            self._sha1     = hashlib.sha1()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, data, owner=None):
+        """
+        Append data to the stream, hashing every piece it completes.
+
+        The data may be any bytes-like object. If the hasher has to keep
+        parts of it beyond this call (in threaded mode only), it calls
+        owner.acquire() and later owner.release() from whatever thread
+        hashed the data, so the caller knows when it may reuse the buffer.
+        Without an owner, the data is copied instead.
+        """
+        view = memoryview(data).cast("B")
+
+        if self._executor is None:
+            self._update_serial(view)
+        else:
+            if owner is None:
+                view = memoryview(bytes(view))
+
+            self._update_threaded(view, owner)
+
+    def _update_serial(self, view):
+        piece_length = self.piece_length
+        pos          = 0
+
+        while pos < len(view):
+            take = min(len(view) - pos, piece_length - self._fill)
+
+            self._sha1.update(view[pos:pos + take])
+            self._fill += take
+            pos        += take
+
+            if self._fill == piece_length:
+                self._store(self._next_index(), self._sha1.digest())
+                self._sha1 = hashlib.sha1()
+                self._fill = 0
+
+    def _update_threaded(self, view, owner):
+        piece_length = self.piece_length
+        pos          = 0
+
+        # Pieces to hand to a worker, the owners it has to release and
+        # whether any of the pieces are slices of view.
+        batch        = []
+        batch_owners = []
+        batch_view   = False
+
+        while pos < len(view):
+            take = min(len(view) - pos, piece_length - self._fill)
+
+            if take == piece_length:
+                # The whole piece is within view.
+                batch.append((self._next_index(), [view[pos:pos + take]]))
+                batch_view = True
+            else:
+                # The piece crosses the boundary of view.
+                self._segments.append(view[pos:pos + take])
+                if owner is not None:
+                    owner.acquire()
+                    self._owners.append(owner)
+
+                self._fill += take
+
+                if self._fill == piece_length:
+                    batch.append((self._next_index(), self._segments))
+                    batch_owners  += self._owners
+                    self._segments = []
+                    self._owners   = []
+                    self._fill     = 0
+
+            pos += take
+
+            if len(batch) * piece_length >= HASH_BATCH_SIZE:
+                self._submit(batch, batch_owners, owner if batch_view else None)
+                batch        = []
+                batch_owners = []
+                batch_view   = False
+
+        if len(batch) > 0:
+            self._submit(batch, batch_owners, owner if batch_view else None)
+
+    def update_zeros(self, length):
+        """
+        Append length zero bytes to the stream.
+
+        The zeros are taken from a shared buffer, and pieces consisting of
+        zeros only are not hashed at all, as their hash is always the same.
+        """
+        piece_length = self.piece_length
+
+        if self._zeros is None:
+            self._zeros = _StaticBuffer(bytes(min(piece_length, MIB)))
+
+        # The zeros completing the current piece, the whole pieces and the
+        # zeros starting the next piece.
+        head  = min(length, -self._fill % piece_length)
+        count = (length - head) // piece_length
+        tail  = length - head - count * piece_length
+
+        self._update_zeros(head)
+
+        if count > 0:
+            if self._zero_digest is None:
+                m = hashlib.sha1()
+                for pos in range(0, piece_length, len(self._zeros.view)):
+                    m.update(self._zeros.view[:piece_length - pos])
+                self._zero_digest = m.digest()
+
+            self.add_digests(self._zero_digest * count)
+
+        self._update_zeros(tail)
+
+    def _update_zeros(self, length):
+        for pos in range(0, length, len(self._zeros.view)):
+            self.update(self._zeros.view[:length - pos], self._zeros)
+
+    def add_digests(self, digests):
+        """
+        Append the already known hashes of whole pieces to the stream.
+
+        This is only possible at a piece boundary.
+        """
+        if self._fill > 0:
+            raise ValueError("cannot add digests in the middle of a piece")
+
+        if len(digests) % 20 != 0:
+            raise ValueError("len(digests) not a multiple of 20")
+
+        for i in range(0, len(digests), 20):
+            self._store(self._next_index(), digests[i:i + 20])
+
+    def wait(self):
+        """
+        Wait until all complete pieces handed out so far have been hashed
+        and return their number.
+        """
+        if self._executor is not None:
+            # Every batch in flight holds one slot.
+            for _ in range(2 * self.workers):
+                self._slots.acquire()
+            for _ in range(2 * self.workers):
+                self._slots.release()
+
+        if self._error is not None:
+            raise self._error
+
+        return self._count
+
+    def finish(self):
+        """
+        Hash the last (probably incomplete) piece, wait for all workers and
+        return the concatenated hashes.
+        """
+        if self._fill > 0:
+            if self._executor is None:
+                self._store(self._next_index(), self._sha1.digest())
+            else:
+                self._submit([(self._next_index(), self._segments)],
+                             self._owners)
+                self._segments = []
+                self._owners   = []
+
+            self._fill = 0
+
+        self.close()
+
+        if self._error is not None:
+            raise self._error
+
+        # Less data than expected?
+        del self.pieces[20 * self._count:]
+
+        return self.pieces
+
+    def close(self):
+        """Wait for and shut down the hashing threads, if any."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def _next_index(self):
+        index        = self._count
+        self._count += 1
+
+        if len(self.pieces) < 20 * self._count:
+            self.pieces.extend(bytes(20 * self._count - len(self.pieces)))
+
+        return index
+
+    def _store(self, index, digest):
+        self.pieces[20 * index:20 * (index + 1)] = digest
+
+    def _submit(self, batch, owners, owner=None):
+        # Some pieces of the batch are slices of owner's memory.
+        if owner is not None:
+            owner.acquire()
+            owners = owners + [owner]
+
+        self._slots.acquire()
+        future = self._executor.submit(self._hash_batch, batch, owners)
+        future.add_done_callback(self._batch_done)
+
+    def _hash_batch(self, batch, owners):
+        try:
+            for index, segments in batch:
+                m = hashlib.sha1()
+                for segment in segments:
+                    m.update(segment)
+                self._store(index, m.digest())
+        finally:
+            for owner in owners:
+                owner.release()
+
+    def _batch_done(self, future):
+        self._slots.release()
+
+        if future.exception() is not None and self._error is None:
+            self._error = future.exception()
+
+class _Block(object):
+    """
+    A read buffer, which returns to its pool once nobody references it any
+    longer.
+    """
+    def __init__(self, pool, size):
+        self.buffer = bytearray(size)
+        self.view   = memoryview(self.buffer)
+
+        self._pool  = pool
+        self._refs  = 0
+        self._lock  = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            self._refs += 1
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+
+        self._pool.put(self)
+
+class _StaticBuffer(object):
+    """
+    A buffer that is never reused, e.g. zeros. There is nothing to do on
+    acquire() and release().
+    """
+    def __init__(self, data):
+        self.view = memoryview(data)
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+class _Mapping(object):
+    """
+    A memory-mapped window of a file.
+
+    The window is unmapped once the last memoryview of it is gone, so there
+    is nothing to do on acquire() and release().
+    """
+    def __init__(self, fileno, offset, length, skip=0):
+        self.mmap = mmap.mmap(fileno, length, access=mmap.ACCESS_READ,
+                              offset=offset)
+        self.view = memoryview(self.mmap)[skip:]
+
+        # The window will be read sequentially and soon.
+        if hasattr(mmap, "MADV_WILLNEED"):
+            self.mmap.madvise(mmap.MADV_WILLNEED)
+
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+def _map_file(fh, start, end, window):
+    """
+    Yield _Mapping objects covering bytes start to end of the given file
+    window by window.
+
+    Raise OSError or ValueError before yielding anything if the file cannot
+    be mapped.
+    """
+    # Offsets must be multiples of the allocation granularity.
+    granularity = mmap.ALLOCATIONGRANULARITY
+    window      = max(window - window % granularity, granularity)
+
+    offset  = start - start % granularity
+    mapping = _Mapping(fh.fileno(), offset, min(window, end - offset),
+                       start - offset)
+
+    while True:
+        yield mapping
+
+        offset += window
+        if offset >= end:
+            break
+
+        mapping = _Mapping(fh.fileno(), offset, min(window, end - offset))
+
+def _fadvise(fd, offset, length, advice):
+    """
+    Advise the kernel how the given part of a file will be accessed (see
+    posix_fadvise(2)), if the platform supports it.
+
+    @param advice: name of the advice, e.g. "POSIX_FADV_SEQUENTIAL".
+    """
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
+
+def _data_regions(fd, start, end):
+    """
+    Yield tuples (start, end, data) dividing bytes start to end of the given
+    file into data (True) and holes (False), using SEEK_DATA and SEEK_HOLE.
+    end must not be beyond the end of the file. If the filesystem cannot
+    tell, everything is data.
+    """
+    while start < end:
+        try:
+            data = os.lseek(fd, start, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                yield start, end, True
+                return
+
+            # Nothing but a hole up to the end of the file.
+            data = end
+
+        data = min(data, end)
+        if data > start:
+            yield start, data, False
+        if data == end:
+            return
+
+        try:
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), end)
+        except OSError:
+            hole = end
+
+        yield data, hole, True
+        start = hole
+
+def _pread_into(fd, view, offset):
+    """
+    Read into the given memoryview from the given offset of the file,
+    without moving the file position. Return the number of bytes read,
+    which is less than len(view) only at the end of the file.
+    """
+    n = 0
+    while n < len(view):
+        if hasattr(os, "preadv"):
+            _n = os.preadv(fd, [view[n:]], offset + n)
+        else:
+            data = os.pread(fd, len(view) - n, offset + n)
+            _n   = len(data)
+            view[n:n + _n] = data
+
+        if not _n:
+            break
+        n += _n
+
+    return n
+
+class RateLimiter(object):
+    """
+    A token bucket limiting the bytes consumed to rate bytes per second.
+
+    The bucket starts empty and holds at most one second's worth of tokens,
+    so a consumer that was idle may burst for up to a second. consume()
+    sleeps until the bytes are paid for and may be called from several
+    threads.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+
+        self._tokens = 0.0
+        self._time   = time.monotonic()
+        self._lock   = threading.Lock()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens +
+                               (now - self._time) * self.rate) - amount
+            self._time   = now
+            delay        = -self._tokens / self.rate
+
+        if delay > 0:
+            time.sleep(delay)
+
+class _StreamReader(object):
+    """
+    Read (parts of) files as one continuous stream.
+
+    The files are read with readinto() into a fixed number of blocks of
+    read_size bytes, which are filled across file boundaries. A block is
+    reused as soon as the reader and everybody else who acquired it have
+    released it, thus waiting for the consumers if all blocks are in use.
+
+    Large sequential reads keep the disk efficient no matter how small the
+    pieces are. In addition, the kernel is told that files are read
+    sequentially and asked to read ahead the next block of the current file
+    while the current one is hashed, as well as the start of the file
+    announced via prefetch().
+
+    Files of at least mmap_threshold bytes are memory-mapped instead, in
+    windows of about read_size bytes, so their data is hashed straight from
+    the page cache. Files that cannot be mapped are read as usual.
+    mmap_threshold=None disables memory-mapping.
+
+    With drop_cache=True, the pages of the files are dropped from the page
+    cache (POSIX_FADV_DONTNEED) as soon as they have been read, so hashing
+    does not evict the data other processes are using. This should be
+    combined with mmap_threshold=None, as mapped pages are not dropped.
+
+    If a limiter (see RateLimiter) is given, every read waits for it.
+
+    With io_depth > 1, files are read with up to io_depth os.pread() calls
+    in flight, each filling (part of) a block, and the data is yielded in
+    order as the reads complete. This is what striped or parallel storage
+    needs to reach its bandwidth. It should be combined with
+    mmap_threshold=None, as mapped files are read by page faults one at a
+    time.
+
+    @note: Truncating a file while it is mapped crashes the process with
+           SIGBUS on most platforms.
+    """
+    def __init__(self, read_size, buffers, mmap_threshold=MMAP_THRESHOLD,
+                 drop_cache=False, limiter=None, io_depth=1):
+        self.read_size      = read_size
+        self.mmap_threshold = mmap_threshold
+        self.drop_cache     = drop_cache
+        self.limiter        = limiter
+        self.io_depth       = io_depth
+
+        self._executor = None
+        if io_depth > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(io_depth)
+
+        self._pool = queue.Queue()
+        for _ in range(buffers):
+            self._pool.put(_Block(self._pool, read_size))
+
+        self._block = None
+        self._pos   = read_size
+
+        # The file opened by prefetch(), as tuple (path, fh).
+        self._prefetched = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def prefetch(self, path, start=0):
+        """
+        Announce that the given file will be read next, starting at start,
+        so the kernel can read ahead while the current file is hashed.
+        """
+        self._close_prefetched()
+
+        try:
+            fh = open(path, "rb", buffering=0)
+        except OSError:
+            # Let read() deal with it.
+            return
+
+        _fadvise(fh.fileno(), start, self.read_size, "POSIX_FADV_WILLNEED")
+        self._prefetched = (path, fh)
+
+    def read(self, path, start=0, end=None, data=None):
+        """
+        Yield tuples (view, owner) for the bytes start to end of the given
+        file, where view is a memoryview of the data within owner.
+        end=None means up to the end of the file.
+
+        If the data has been read before (see _Prefetcher), it is given as
+        data and copied into the blocks instead.
+
+        The holes of sparse files are found with SEEK_DATA and SEEK_HOLE
+        and not read. For each hole, (None, length) is yielded instead,
+        meaning length zero bytes.
+        """
+        if data is not None:
+            while data:
+                if self._pos == self.read_size:
+                    self._next_block()
+
+                n = min(self.read_size - self._pos, len(data))
+                self._block.view[self._pos:self._pos + n] = data[:n]
+
+                yield self._block.view[self._pos:self._pos + n], self._block
+                self._pos += n
+                data       = data[n:]
+            return
+
+        if self._prefetched is not None and self._prefetched[0] == path:
+            fh = self._prefetched[1]
+            self._prefetched = None
+        else:
+            fh = open(path, "rb", buffering=0)
+
+        with fh:
+            st   = os.fstat(fh.fileno())
+            size = st.st_size
+            if end is None:
+                end = size
+
+            # Fewer blocks allocated than needed for the size means holes.
+            sparse = hasattr(os, "SEEK_DATA") and \
+                     getattr(st, "st_blocks", size) * 512 < size
+
+            _fadvise(fh.fileno(), start, 0, "POSIX_FADV_SEQUENTIAL")
+
+            if not sparse and self.mmap_threshold is not None and \
+               size >= self.mmap_threshold and min(size, end) > start:
+                try:
+                    mappings = _map_file(fh, start, min(size, end),
+                                         self.read_size)
+                    mapping  = next(mappings)
+                except (OSError, ValueError):
+                    pass
+                else:
+                    for mapping in itertools.chain([mapping], mappings):
+                        if self.limiter is not None:
+                            self.limiter.consume(len(mapping.view))
+
+                        yield mapping.view, mapping
+                        start += len(mapping.view)
+                    del mapping
+
+            # The rest of the file, unless it has all been mapped. The holes
+            # of sparse files are not read.
+            if sparse:
+                regions = itertools.chain(
+                    _data_regions(fh.fileno(), start, min(size, end)),
+                    [(size, end, True)] if end > size else [])
+            else:
+                regions = [(start, end, True)]
+
+            for start, end, data in regions:
+                if not data:
+                    yield None, end - start
+                    continue
+
+                if self._executor is not None and \
+                   end - start > self.read_size:
+                    eof = yield from self._read_parallel(fh, start, end)
+                else:
+                    eof = yield from self._read_sequential(fh, start, end)
+
+                if eof:
+                    break
+
+    def _read_sequential(self, fh, start, end):
+        # Read bytes start to end of the file block by block. Return True
+        # if the end of the file came first.
+        fh.seek(start)
+
+        while start < end:
+            if self._pos == self.read_size:
+                self._next_block()
+
+            n = fh.readinto(self._block.view[self._pos:self._pos +
+                                             min(self.read_size - self._pos,
+                                                 end - start)])
+            if not n:
+                return True
+
+            if self.drop_cache:
+                _fadvise(fh.fileno(), start, n, "POSIX_FADV_DONTNEED")
+
+            if self.limiter is not None:
+                self.limiter.consume(n)
+
+            # Have the next block read while this one is hashed.
+            if start + n < end:
+                _fadvise(fh.fileno(), start + n,
+                         min(self.read_size, end - start - n),
+                         "POSIX_FADV_WILLNEED")
+
+            yield self._block.view[self._pos:self._pos + n], self._block
+            self._pos += n
+            start     += n
+
+        return False
+
+    def _read_parallel(self, fh, start, end):
+        # Like _read_sequential(), but with up to io_depth reads in flight.
+        # Every pending read holds a reference to its block.
+        pending = collections.deque()
+        eof     = False
+
+        while pending or (start < end and not eof):
+            while start < end and not eof and len(pending) < self.io_depth:
+                if self._pos == self.read_size:
+                    self._next_block()
+
+                length = min(self.read_size - self._pos, end - start)
+                view   = self._block.view[self._pos:self._pos + length]
+
+                self._block.acquire()
+                pending.append((self._executor.submit(_pread_into,
+                                                      fh.fileno(), view,
+                                                      start),
+                                start, self._pos, view, self._block))
+
+                self._pos += length
+                start     += length
+
+            future, offset, pos, view, block = pending.popleft()
+            n = future.result()
+
+            if n < len(view):
+                # The file has shrunk. Continue the stream right after the
+                # data read and give up the reads after it.
+                eof   = True
+                start = end
+
+                for future, _, _, _, _block in pending:
+                    concurrent.futures.wait([future])
+                    _block.release()
+                pending.clear()
+
+                block.acquire()
+                self._block.release()
+                self._block = block
+                self._pos   = pos + n
+
+            if n:
+                if self.drop_cache:
+                    _fadvise(fh.fileno(), offset, n, "POSIX_FADV_DONTNEED")
+
+                if self.limiter is not None:
+                    self.limiter.consume(n)
+
+                yield view[:n], block
+
+            block.release()
+
+        return eof
+
+    def close(self):
+        self._close_prefetched()
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._block is not None:
+            self._block.release()
+            self._block = None
+
+    def _close_prefetched(self):
+        if self._prefetched is not None:
+            self._prefetched[1].close()
+            self._prefetched = None
+
+    def _next_block(self):
+        if self._block is not None:
+            self._block.release()
+
+        self._block = self._pool.get()
+        self._block.acquire()
+        self._pos   = 0
+
+class _Prefetcher(object):
+    """
+    Read small files ahead of time, concurrently.
+
+    reads is the list of reads (path, start, end) of the files in the order
+    they are consumed, where entries that should not be prefetched are
+    None. end=None means up to the end of the file. Every entry must fit
+    into buffer_size bytes.
+
+    The reads are started in order by the given number of threads, each
+    into one of a fixed number of buffers, so at most buffers * buffer_size
+    bytes are held. get() returns the data of the reads in order, and each
+    buffer has to be given back via release() once its data is consumed.
+
+    No threads are started if there is nothing to prefetch.
+
+    drop_cache and limiter are as for _StreamReader.
+    """
+    def __init__(self, reads, threads, buffers, buffer_size, drop_cache=False,
+                 limiter=None):
+        self.reads      = reads
+        self.drop_cache = drop_cache
+        self.limiter    = limiter
+
+        self._pool = queue.Queue()
+        for _ in range(buffers):
+            self._pool.put(bytearray(buffer_size))
+
+        # The futures of the reads started, by index.
+        self._futures   = {}
+        self._condition = threading.Condition()
+        self._closed    = False
+
+        if not any(reads):
+            self._executor = None
+            return
+
+        self._executor   = concurrent.futures.ThreadPoolExecutor(threads)
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            daemon=True)
+        self._dispatcher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _dispatch(self):
+        for index, read in enumerate(self.reads):
+            if read is None:
+                continue
+
+            buffer = self._pool.get()
+
+            with self._condition:
+                if self._closed:
+                    break
+
+                self._futures[index] = self._executor.submit(self._read,
+                                                             buffer, *read)
+                self._condition.notify_all()
+
+    def _read(self, buffer, path, start, end):
+        # Return a tuple (buffer, n) with the first n bytes of buffer read,
+        # or (buffer, None) if the file does not fit into the buffer.
+        view = memoryview(buffer)
+        if end is not None:
+            view = view[:end - start]
+
+        with open(path, "rb", buffering=0) as fh:
+            if start:
+                fh.seek(start)
+
+            n = 0
+            while n < len(view):
+                _n = fh.readinto(view[n:])
+                if not _n:
+                    break
+                n += _n
+
+            # The file has grown beyond the buffer.
+            if end is None and n == len(buffer) and fh.read(1):
+                return buffer, None
+
+            if self.drop_cache:
+                _fadvise(fh.fileno(), start, n, "POSIX_FADV_DONTNEED")
+
+        if self.limiter is not None:
+            self.limiter.consume(n)
+
+        return buffer, n
+
+    def get(self, index):
+        """
+        Return a tuple (view, buffer) with the data of the given read,
+        waiting for it if necessary, or None if it is not prefetched.
+
+        Errors of the read (e.g. OSError) are raised here.
+        """
+        if self.reads[index] is None:
+            return None
+
+        with self._condition:
+            while index not in self._futures:
+                self._condition.wait()
+            future = self._futures.pop(index)
+
+        buffer, n = future.result()
+        if n is None:
+            self.release(buffer)
+            return None
+
+        return memoryview(buffer)[:n], buffer
+
+    def release(self, buffer):
+        """Give back a buffer returned by get()."""
+        self._pool.put(buffer)
+
+    def close(self):
+        if self._executor is None:
+            return
+
+        with self._condition:
+            self._closed = True
+
+        # Wake up the dispatcher if it waits for a buffer.
+        self._pool.put(bytearray())
+        self._dispatcher.join()
+        self._executor.shutdown(cancel_futures=True)
+
+class _FileDigests(object):
+    """
+    Calculate per-file digests (e.g. MD5 and SHA-256) of the data read for
+    the pieces, each algorithm on a thread of its own.
+
+    update() hands data of a file to the threads of the given algorithms.
+    Its owner is acquired until every one of them has digested it (see
+    PieceHasher.update()), so the data is neither copied nor read again.
+    hashlib releases the GIL while hashing, thus the digests are calculated
+    in parallel to the pieces.
+    """
+    def __init__(self, algorithms, count):
+        self.algorithms = algorithms
+
+        self._zeros   = bytes(MIB)
+        self._error   = None
+        self._hashes  = {name: [None] * count for name in algorithms}
+        self._queues  = {name: queue.Queue() for name in algorithms}
+        self._threads = [threading.Thread(target=self._run, args=(name,),
+                                          daemon=True)
+                         for name in algorithms]
+
+        for thread in self._threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, names, index, view, owner):
+        """
+        Digest data of the file with the given index for the given
+        algorithms. view=None means owner zero bytes (a hole).
+        """
+        for name in names:
+            if view is not None:
+                owner.acquire()
+            self._queues[name].put((index, view, owner))
+
+    def _run(self, name):
+        hashes = self._hashes[name]
+        jobs   = self._queues[name]
+
+        while True:
+            item = jobs.get()
+            if item is None:
+                jobs.task_done()
+                break
+
+            index, view, owner = item
+            try:
+                if self._error is None:
+                    if hashes[index] is None:
+                        hashes[index] = hashlib.new(name)
+
+                    if view is None:
+                        for pos in range(0, owner, len(self._zeros)):
+                            hashes[index].update(self._zeros[:owner - pos])
+                    else:
+                        hashes[index].update(view)
+            except Exception as exc:
+                self._error = exc
+            finally:
+                if view is not None:
+                    owner.release()
+                jobs.task_done()
+
+    def wait(self):
+        """Wait until all data handed out so far has been digested."""
+        for jobs in self._queues.values():
+            jobs.join()
+
+        if self._error is not None:
+            raise self._error
+
+    def hexdigest(self, name, index):
+        """
+        Return the hex digest of the data of the given file digested so
+        far, see wait().
+        """
+        digest = self._hashes[name][index]
+        if digest is None:
+            digest = hashlib.new(name)
+        return digest.hexdigest()
+
+    def close(self):
+        """Stop the threads."""
+        for jobs in self._queues.values():
+            jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+
+def write_bencoded(path, thing):
+    """
+    Atomically write the bencoded object (e.g. a torrent's metainfo) to the
+    given path.
+
+    The data is streamed into a temporary file next to path, which then
+    replaces path, so path is never left incomplete, not even on
+    KeyboardInterrupt.
+    """
+    tmp_path = path + ".tmp"
+
+    try:
+        with open(tmp_path, "wb") as fh:
+            bencode_to_file(fh, thing)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class _Journal(object):
+    """
+    The checkpoints of hash_files(), from which hashing can be resumed.
+
+    The journal at path consists of three files:
+      - path:        a bencoded header with the file list snapshot, the
+                     piece length and whether the files are aligned to
+                     pieces, written once by start().
+      - path.pieces: the hashes of the pieces completed so far.
+      - path.sums:   a line "<index> <algorithm> <checksum>" for every
+                     checksum (e.g. 'md5') of the files completed so far.
+
+    The latter two are only ever appended to, so a checkpoint writes just
+    the hashes and checksums that are new since the one before. An
+    interrupted checkpoint leaves at most a partial hash or line at their
+    end, which read() ignores and start() truncates.
+    """
+    def __init__(self, path, snapshot, piece_length, align_files=False):
+        self.path         = path
+        self.snapshot     = snapshot
+        self.piece_length = piece_length
+        self.align_files  = align_files
+
+        self.pieces_path = path + ".pieces"
+        self.sums_path   = path + ".sums"
+
+        # The valid sizes of the files appended to and the number of files
+        # whose checksums have been written.
+        self._pieces_size = 0
+        self._sums_size   = 0
+        self._files       = 0
+
+    @staticmethod
+    def paths(path):
+        """Return the paths of all files of the journal at path."""
+        return [path, path + ".pieces", path + ".sums"]
+
+    def read(self, algorithms):
+        """
+        Return the tuple (pieces, checksums) checkpointed in the journal, or
+        None if it does not exist or cannot be used to resume hashing.
+        checksums maps each of the given algorithms to the list of the
+        files' checksums ('' if unknown).
+
+        The journal can only be used if the piece length and alignment are
+        the same and all files up to the last checkpointed piece are
+        unchanged since, according to their paths, sizes and modification
+        times.
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        try:
+            with open(self.path, "rb") as fh:
+                header = bdecode(fh.read(), decode_strings=False)
+
+            files = [(_str(f[b'path']), f[b'length'], f[b'mtime_ns'])
+                     for f in header[b'files']]
+
+            if header[b'version'] != JOURNAL_VERSION or \
+               header[b'piece length'] != self.piece_length or \
+               header[b'aligned'] != int(self.align_files):
+                raise ValueError("journal does not match")
+
+            # Only whole pieces count.
+            with open(self.pieces_path, "rb") as fh:
+                pieces = fh.read()
+            pieces = pieces[:len(pieces) - len(pieces) % 20]
+            offset = self.piece_length * (len(pieces) // 20)
+
+            # Compare all files starting before the offset, and count the
+            # files ending before it.
+            start    = 0
+            complete = 0
+            for index, file in enumerate(files):
+                if start >= offset:
+                    break
+
+                if index >= len(self.snapshot) or \
+                   self.snapshot[index] != file:
+                    raise ValueError("'%s' has changed" % file[0])
+
+                start += file[1]
+                if start <= offset:
+                    complete = index + 1
+                if self.align_files:
+                    start += -file[1] % self.piece_length
+
+            # Only complete lines count.
+            checksums = {name: [''] * len(self.snapshot)
+                         for name in algorithms}
+            sums_size = 0
+            files     = complete if not algorithms else 0
+
+            with open(self.sums_path, "rb") as fh:
+                for line in fh:
+                    if not line.endswith(b"\n"):
+                        break
+
+                    index, name, checksum = line.decode("ascii").split()
+                    index = int(index)
+                    if index >= complete:
+                        break
+
+                    if name in checksums:
+                        checksums[name][index] = checksum
+                        files = max(files, index + 1)
+
+                    sums_size += len(line)
+        except (DecodingException, KeyError, TypeError, ValueError,
+                OSError) as exc:
+            print("Warning: cannot resume from journal '%s' (%s), starting "
+                  "over." % (self.path, exc), file=sys.stderr)
+            return None
+
+        self._pieces_size = len(pieces)
+        self._sums_size   = sums_size
+        self._files       = files
+
+        return pieces, checksums
+
+    def start(self):
+        """
+        Truncate the files appended to, to what read() has found to be
+        valid (nothing, unless it has been called successfully), and write
+        the header.
+        """
+        # The header of a previous journal must not outlive hashes of
+        # changed files, thus it is replaced last.
+        for path, size in [(self.pieces_path, self._pieces_size),
+                           (self.sums_path,   self._sums_size)]:
+            with open(path, "ab") as fh:
+                fh.truncate(size)
+                os.fsync(fh.fileno())
+
+        write_bencoded(self.path, {
+            'version':      JOURNAL_VERSION,
+            'piece length': self.piece_length,
+            'files':        [{'path':     file,
+                              'length':   length,
+                              'mtime_ns': mtime_ns}
+                             for file, length, mtime_ns in self.snapshot],
+            'aligned':      int(self.align_files),
+            })
+
+    def checkpoint(self, pieces, count, ends, limit, checksum, algorithms):
+        """
+        Append the hashes of the first count pieces (the pieces completed so
+        far) that are new since the last checkpoint, as well as the
+        checksums of the files completed since. The files end at the given
+        offsets of the stream, and only the first limit files are complete
+        as far as their checksums are concerned. checksum(name, index)
+        returns the checksum of a complete file.
+        """
+        with open(self.pieces_path, "ab") as fh:
+            fh.write(pieces[self._pieces_size:20 * count])
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._pieces_size = 20 * count
+
+        offset = self.piece_length * count
+        lines  = []
+        while self._files < limit and ends[self._files] <= offset:
+            lines.extend("%d %s %s\n" % (self._files, name,
+                                          checksum(name, self._files))
+                         for name in algorithms)
+            self._files += 1
+
+        if lines:
+            with open(self.sums_path, "ab") as fh:
+                fh.write("".join(lines).encode("ascii"))
+                fh.flush()
+                os.fsync(fh.fileno())
+
+def hash_files(paths, piece_length, include_md5=False, workers=1,
+               read_size=READ_SIZE, mmap_threshold=MMAP_THRESHOLD,
+               cache=None, journal=None, resume=False,
+               checkpoint_interval=CHECKPOINT_INTERVAL, prefix=None,
+               align_files=False, drop_cache=False, max_read_rate=None,
+               stats=None, prefetch_depth=PREFETCH_DEPTH,
+               small_file_size=SMALL_FILE_SIZE, io_depth=1,
+               include_sha256=False, progress=None):
+    """
+    Hash the given files as one continuous stream of pieces.
+
+    Return dictionary with the following keys:
+      - pieces:     concatenated 20-byte-sha1-hashes
+      - lengths:    list of the files' sizes in bytes
+      - md5sums:    list of the files' md5sums (None unless include_md5)
+      - sha256sums: list of the files' SHA-256 sums in hex (None unless
+                    include_sha256)
+      - pads:       list of the number of zero bytes following each file
+
+    The files are read only once. The MD5 and SHA-256 sums are calculated
+    from the same data as the pieces, on threads of their own (see
+    _FileDigests).
+
+    The files are read read_size bytes at a time, independent of the piece
+    length, and the pieces are hashed by the given number of threads.
+    Files of at least mmap_threshold bytes are memory-mapped instead of
+    read (None = never). Files of up to small_file_size bytes are read
+    ahead by prefetch_depth threads (0 = disabled, see _Prefetcher), so many
+    small files are read concurrently instead of one at a time. Larger
+    files are read with up to io_depth reads in flight (see _StreamReader),
+    which disables memory-mapping if io_depth > 1.
+
+    To limit the impact on other users of the storage, drop_cache=True
+    drops the files from the page cache once they have been read (and
+    disables memory-mapping), and max_read_rate limits reading to the given
+    number of bytes per second.
+
+    With align_files=True, every file but the last is followed by zeros up
+    to the next piece boundary (see BEP 47), so its pieces only depend on
+    its own content.
+
+    If a cache (see hashcache.HashCache) is given, the hashes of the pieces
+    lying completely within an unchanged file are taken from it, and only
+    the bytes before and after them are read. Files hashed in full are
+    added to the cache. Likewise, a file that is another file's hardlink
+    and starts at the same offset within a piece is hashed only once.
+
+    If a journal path is given, a checkpoint is written to it every
+    checkpoint_interval seconds (see _Journal). With resume=True, hashing
+    continues after the last checkpoint of the journal, provided the files
+    before it are unchanged. The journal is not removed, that is up to the
+    caller (see _Journal.paths()).
+
+    A prefix, as returned by get_update_prefix(), provides the hashes of
+    the first pieces and the MD5 sums of the files they cover, which are
+    then not hashed again. Their SHA-256 sums, which neither cache nor
+    torrent contain, require reading the files though.
+
+    stats may provide the files' os.stat() results, e.g. from
+    get_files_in_directory(with_stat=True), so they are not stat()-ed
+    again.
+
+    progress, if given, is called as progress(done, total) whenever a block
+    has been read, where done is the number of bytes of the stream hashed
+    or known so far and total its length (including padding). If it raises
+    an exception, hashing is aborted.
+    """
+    if stats is None:
+        stats = [os.stat(path) for path in paths]
+
+    snapshot = [(os.path.abspath(path), st.st_size, st.st_mtime_ns)
+                for path, st in zip(paths, stats)]
+
+    if align_files:
+        pads = [-st.st_size % piece_length for st in stats[:-1]] + [0]
+    else:
+        pads = [0] * len(paths)
+
+    lengths = [0] * len(paths)
+
+    # The per-file checksums by algorithm, as far as they are known.
+    algorithms = ['md5'] * include_md5 + ['sha256'] * include_sha256
+    checksums  = {name: [None] * len(paths) for name in algorithms}
+
+    # Hardlinks whose checksums are those of another file, by index.
+    sources = {}
+
+    # Start offset of every file within the stream, and the stream's length.
+    starts = list(itertools.accumulate([0] + [st.st_size + pad for st, pad
+                                              in zip(stats, pads)]))
+    ends   = [start + st.st_size for start, st in zip(starts, stats)]
+
+    # The plan: (kind, index, start, end, digests) for every part of a file,
+    # where kind is one of:
+    # - 'hash':     read the part and hash it.
+    # - 'known':    the piece hashes of the part are already known.
+    # - 'copy':     the part's piece hashes are those of pieces first to
+    #               last (given as digests) of another file, which is hashed
+    #               before.
+    # - 'checksum': read the part, but only for the file's checksums.
+    # - 'zeros':    hash part of the padding following the file.
+    # Files that have to be read entirely are remembered together with
+    # their cache key and the range of their pieces.
+    plan     = []
+    uncached = []
+
+    # Files to be hashed entirely, by cache key.
+    hashed   = {}
+
+    # The hashes and checksums known from before, and where to continue
+    # hashing.
+    checkpoint = None
+    offset     = 0
+
+    if prefix is not None:
+        checkpoint = (prefix[0], {'md5': prefix[1]})
+
+    if journal is not None:
+        journal = _Journal(journal, snapshot, piece_length, align_files)
+
+        if resume:
+            checkpoint = journal.read(algorithms) or checkpoint
+
+    if checkpoint is not None:
+        plan.append(('known', None, 0, 0, checkpoint[0]))
+        offset = piece_length * (len(checkpoint[0]) // 20)
+
+    # Without alignment, the size is only known once the file has been
+    # read.
+    size = None
+
+    for index, st in enumerate(stats):
+        start = starts[index]
+        end   = ends[index]
+
+        if align_files:
+            size = st.st_size
+
+        if end <= offset:
+            # The file has been hashed before.
+            lengths[index] = st.st_size
+            for name in algorithms:
+                known = checkpoint[1].get(name)
+                if known is not None and known[index]:
+                    checksums[name][index] = known[index]
+
+            if any(checksums[name][index] is None for name in algorithms):
+                plan.append(('checksum', index, 0, size, None))
+        elif start < offset:
+            # Continuing in the middle of the file.
+            if algorithms:
+                plan.append(('checksum', index, 0, offset - start, None))
+            lengths[index] = offset - start
+            plan.append(('hash', index, offset - start, size, None))
+        else:
+            # Pieces first to last lie completely within the file.
+            first = -(-start // piece_length)
+            last  = end // piece_length
+
+            key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns,
+                   piece_length, start % piece_length)
+
+            entry = None
+            if cache is not None and last > first:
+                entry = cache.get(key)
+                if entry is not None and \
+                   (len(entry[0]) != 20 * (last - first) or
+                    include_md5 and entry[1] is None or include_sha256):
+                    entry = None
+
+            if entry is None and key in hashed:
+                entry = ('copy', hashed[key])
+                sources[index] = hashed[key][0]
+            elif entry is not None:
+                if include_md5:
+                    checksums['md5'][index] = entry[1]
+                entry = ('known', entry[0])
+
+            if entry is None:
+                plan.append(('hash', index, 0, size, None))
+                if last > first:
+                    hashed[key] = (index, first, last)
+                if cache is not None and last > first:
+                    uncached.append((index, key, first, last))
+            else:
+                head = first * piece_length - start
+                tail = last  * piece_length - start
+
+                if head > 0:
+                    plan.append(('hash', index, 0, head, None))
+                plan.append((entry[0], index, head, tail, entry[1]))
+                plan.append(('hash', index, tail, size, None))
+                lengths[index] = tail - head
+
+        # The padding following the file, as far as it is not hashed yet.
+        if max(end, offset) < starts[index + 1]:
+            plan.append(('zeros', index, max(end, offset) - end, pads[index],
+                         None))
+
+    # Enough blocks for the current piece, the reader and its reads in
+    # flight and, in threaded mode, the batches waiting for a worker.
+    buffers = 2 + -(-piece_length // read_size) + io_depth
+    if workers > 1:
+        buffers += -(-2 * workers * max(piece_length, HASH_BATCH_SIZE)
+                     // read_size)
+
+    if journal is not None:
+        journal.start()
+
+    next_checkpoint = time.monotonic() + checkpoint_interval
+
+    if drop_cache or io_depth > 1:
+        mmap_threshold = None
+
+    limiter = None
+    if max_read_rate is not None:
+        limiter = RateLimiter(max_read_rate)
+
+    # The parts of files that are read, in the order of the plan.
+    reads = [(index, start, end) for kind, index, start, end, _ in plan
+             if kind in ('hash', 'checksum')]
+    read_count = 0
+
+    # The reads of small files are prefetched.
+    small_reads = [(paths[index], start, end)
+                   if prefetch_depth > 0 and
+                      stats[index].st_size - start <= small_file_size
+                   else None
+                   for index, start, end in reads]
+
+    reads.append((None, 0, None))
+    small_reads.append(None)
+
+    # The number of bytes of the stream hashed so far (see progress).
+    done = 0
+
+    with PieceHasher(piece_length, starts[-1], workers) as hasher, \
+         _StreamReader(read_size, buffers, mmap_threshold, drop_cache,
+                       limiter, io_depth) as reader, \
+         _Prefetcher(small_reads, prefetch_depth, prefetch_depth,
+                     small_file_size, drop_cache, limiter) as prefetcher, \
+         _FileDigests(algorithms, len(paths)) as digests:
+
+        def _checksum(name, index):
+            index = sources.get(index, index)
+            return checksums[name][index] or digests.hexdigest(name, index)
+
+        for kind, index, start, end, known in plan:
+            if kind == 'known':
+                hasher.add_digests(known)
+                done += piece_length * (len(known) // 20) if index is None \
+                        else end - start
+                continue
+
+            if kind == 'copy':
+                source, first, last = known
+
+                hasher.wait()
+                hasher.add_digests(bytes(hasher.pieces[20 * first:20 * last]))
+                done += end - start
+                continue
+
+            if kind == 'zeros':
+                hasher.update_zeros(end - start)
+                done += end - start
+                continue
+
+            data = prefetcher.get(read_count)
+
+            # The checksums still to be calculated for the file.
+            names = [name for name in algorithms
+                     if checksums[name][index] is None]
+
+            # Announce the next file to be read, unless it is prefetched.
+            read_count += 1
+            next_index, next_start, _ = reads[read_count]
+            if next_index is not None and next_index != index and \
+               small_reads[read_count] is None:
+                reader.prefetch(paths[next_index], next_start)
+
+            for view, owner in reader.read(paths[index], start, end,
+                                           data and data[0]):
+                if view is None:
+                    # A hole of owner zero bytes.
+                    if kind == 'hash':
+                        lengths[index] += owner
+                        hasher.update_zeros(owner)
+                        done += owner
+                elif kind == 'hash':
+                    lengths[index] += len(view)
+                    hasher.update(view, owner)
+                    done += len(view)
+
+                digests.update(names, index, view, owner)
+
+                if progress is not None:
+                    progress(done, starts[-1])
+
+                if journal is not None and \
+                   time.monotonic() >= next_checkpoint:
+                    # Files before the one being read that end before
+                    # the checkpoint are complete.
+                    count = hasher.wait()
+                    digests.wait()
+
+                    journal.checkpoint(hasher.pieces, count, ends, index,
+                                       _checksum, algorithms)
+                    next_checkpoint = time.monotonic() + checkpoint_interval
+
+            if data is not None:
+                prefetcher.release(data[1])
+
+        if progress is not None:
+            progress(done, starts[-1])
+
+        pieces    = hasher.finish()
+        digests.wait()
+        checksums = {name: [_checksum(name, index)
+                            for index in range(len(paths))]
+                     for name in algorithms}
+
+    for index, key, first, last in uncached:
+        if lengths[index] == key[2]:
+            cache.put(key, bytes(pieces[20 * first:20 * last]),
+                      checksums['md5'][index] if include_md5 else None)
+
+    return {
+           'pieces':     pieces,
+           'lengths':    lengths,
+           'md5sums':    checksums.get('md5'),
+           'sha256sums': checksums.get('sha256'),
+           'pads':       pads
+           }
+
+def _hash_range(paths, starts, ends, offset, length):
+    """
+    Return the SHA-1 hash of length bytes at the given offset of the stream
+    formed by the given files, which start and end at the given offsets.
+    The stream is zero between the end of one file and the start of the
+    next (padding).
+    """
+    m     = hashlib.sha1()
+    index = bisect.bisect_right(starts, offset) - 1
+
+    while length > 0 and index < len(paths):
+        if offset < ends[index]:
+            with open(paths[index], "rb") as fh:
+                fh.seek(offset - starts[index])
+                data = fh.read(min(length, ends[index] - offset))
+        else:
+            data = bytes(min(length, starts[index + 1] - offset))
+
+        m.update(data)
+        offset += len(data)
+        length -= len(data)
+
+        if offset >= starts[index + 1] or not data:
+            index += 1
+
+    return m.digest()
+
+def get_update_prefix(metainfo, directory, files, samples=UPDATE_SAMPLES,
+                      align_files=False):
+    """
+    Return the part of an existing multi-file torrent that is still valid
+    for the given files of the directory, for use as hash_files()' prefix.
+
+    The torrent's files must be the first of the given files, with the same
+    paths and sizes, and aligned to pieces (with padding files) if and only
+    if align_files. A sample of the pieces (the first, the last and some
+    random ones) is hashed again and compared to the torrent, as the data
+    may have changed without changing the sizes.
+
+    The result is a tuple (pieces, md5sums), where pieces are the hashes of
+    all pieces completely covered by the torrent's files and md5sums the
+    MD5 sums found in the torrent (None where there are none).
+
+    Raise ValueError if the torrent does not match the files.
+
+    @param metainfo: the torrent, bdecode()-d with decode_strings=False.
+    """
+    info = metainfo[b'info']
+
+    if b'files' not in info:
+        raise ValueError("only torrents for directories can be updated")
+
+    piece_length = info[b'piece length']
+    pieces       = info[b'pieces']
+
+    # The torrent's real files, each with the padding following it.
+    old_files = []
+    for old_file in info[b'files']:
+        if b'p' in old_file.get(b'attr', b''):
+            if len(old_files) == 0 or old_files[-1][1] > 0:
+                raise ValueError("the torrent contains unexpected padding")
+
+            old_files[-1][1] = old_file[b'length']
+        else:
+            old_files.append([old_file, 0])
+
+    if len(old_files) > len(files):
+        raise ValueError("the torrent contains more files than the directory")
+
+    paths  = [os.path.join(directory, file) for file in files]
+    starts = [0]
+    ends   = []
+
+    for index, (file, path) in enumerate(zip(files, paths)):
+        if index == len(old_files):
+            break
+
+        old_file, padding = old_files[index]
+        old_path = [_str(part) for part in old_file[b'path']]
+
+        if old_path != split_path(file):
+            raise ValueError("'%s' is not the next file in the directory"
+                             % os.path.join(*old_path))
+
+        if old_file[b'length'] != os.path.getsize(path):
+            raise ValueError("the size of '%s' has changed" % file)
+
+        # The last file has no padding (yet).
+        if align_files and index < len(old_files) - 1:
+            expected_padding = -old_file[b'length'] % piece_length
+        else:
+            expected_padding = 0
+
+        if padding != expected_padding:
+            raise ValueError("the files of the torrent are %s to pieces"
+                             % ("not aligned" if align_files else "aligned"))
+
+        ends.append(starts[-1] + old_file[b'length'])
+        starts.append(ends[-1] + padding)
+
+    if len(pieces) != 20 * -(-starts[-1] // piece_length):
+        raise ValueError("the torrent contains the wrong number of pieces")
+
+    # Only whole pieces can be kept, the last piece will be extended.
+    count = starts[-1] // piece_length
+
+    if count > 0:
+        indices  = {0, count - 1}
+        indices |= set(random.sample(range(count), min(samples, count)))
+
+        for index in sorted(indices):
+            if _hash_range(paths, starts, ends, index * piece_length,
+                           piece_length) != pieces[20 * index:20 * (index + 1)]:
+                raise ValueError("the data of piece %d has changed" % index)
+
+    md5sums = [_str(old_file[b'md5sum']) if b'md5sum' in old_file else None
+               for old_file, _ in old_files]
+    md5sums.extend([None] * (len(files) - len(old_files)))
+
+    return pieces[:20 * count], md5sums
+
+def create_single_file_info(file, piece_length, include_md5=True,
+                            sha256sums=None, **options):
     """
     Return dictionary with the following keys:
       - pieces: concatenated 20-byte-sha1-hashes
@@ -49,52 +1719,46 @@ def create_single_file_info(file, piece_length, include_md5=True):
       - length: size of the file in bytes
       - md5sum: md5sum of the file (unless disabled via include_md5)
 
+    If a dictionary is given as sha256sums, the file's SHA-256 sum (in
+    hex) is stored in it by its basename, without reading the file again.
+
+    Further keyword arguments (workers, read_size, ...) are passed on to
+    hash_files().
+
     @see:   BitTorrent Metainfo Specification.
     @note:  md5 hashes in torrents are actually optional
     """
     assert os.path.isfile(file), "not a file"
 
-    # Total byte count.
-    length = 0
-
-    # Concatenated 20byte sha1-hashes of all the file's pieces.
-    pieces = bytearray()
-
-    md5 = hashlib.md5() if include_md5 else None
-
-    with open(file, "rb") as fh:
-        while True:
-            piece_data = fh.read(piece_length)
-
-            _len = len(piece_data)
-            if _len == 0:
-                break
+    result = hash_files([file], piece_length, include_md5,
+                        include_sha256=sha256sums is not None, **options)
 
-            if include_md5:
-                md5.update(piece_data)
+    if sha256sums is not None:
+        sha256sums[os.path.basename(file)] = result['sha256sums'][0]
 
-            length += _len
-
-            pieces += sha1_20(piece_data)
+    # Total byte count.
+    length = result['lengths'][0]
 
     assert length > 0, "empty file"
 
     info =  {
-            'pieces': pieces,
+            'pieces': result['pieces'],
             'name':   os.path.basename(file),
             'length': length,
             
             }
 
     if include_md5:
-        info['md5sum'] = md5.hexdigest()
+        info['md5sum'] = result['md5sums'][0]
 
     return info
 
 def create_multi_file_info(directory,
                            files,
                            piece_length,
-                           include_md5=True):
+                           include_md5=True,
+                           sha256sums=None,
+                           **options):
     """
     Return dictionary with the following keys:
       - pieces: concatenated 20-byte-sha1-hashes
@@ -108,79 +1772,462 @@ def create_multi_file_info(directory,
                   -> ["dir1", "dir2", "file.ext"]
                   -> ["just_in_the_initial_directory_itself.ext"]
 
-    @see:   BitTorrent Metainfo Specification.
+    With align_files=True, files are followed by padding files, so that
+    every file starts on a piece boundary. Padding files have the key
+    'attr' set to 'p' and the path ['.pad', '<length>'].
+
+    If a dictionary is given as sha256sums, the files' SHA-256 sums (in hex)
+    are stored in it by the files' paths as given, without reading the
+    files again.
+
+    Further keyword arguments (workers, read_size, align_files, ...) are
+    passed on to hash_files().
+
+    @see:   BitTorrent Metainfo Specification, BEP 47 (padding files).
     @note:  md5 hashes in torrents are actually optional
     """
     assert os.path.isdir(directory), "not a directory"
 
-    # Concatenated 20byte sha1-hashes of all the torrent's pieces.
-    info_pieces = bytearray()
+    # Consecutive files are hashed as a continuous stream, as required by
+    # the BitTorrent specification.
+    result = hash_files([os.path.join(directory, file) for file in files],
+                        piece_length, include_md5,
+                        include_sha256=sha256sums is not None, **options)
+
+    if sha256sums is not None:
+        sha256sums.update(zip(files, result['sha256sums']))
 
     #
     info_files = []
 
-    # This bytearray will be used for the calculation of info_pieces.
-    # At some point, every file's data will be written into data. Consecutive
-    # files will be written into data as a continuous stream, as required
-    # by info_pieces' BitTorrent specification.
-    data = bytearray()
+    for index, file in enumerate(files):
+        # Build the current file's dictionary.
+        fdict = {
+                'length': result['lengths'][index],
+                'path':   split_path(file)
+                }
 
-    for file in files:
-        path = os.path.join(directory, file)
+        if include_md5:
+            fdict['md5sum'] = result['md5sums'][index]
 
-        # File's byte count.
-        length = 0
+        info_files.append(fdict)
 
-        # File's md5sum.
-        md5 = hashlib.md5() if include_md5 else None
+        # Add a padding file (BEP 47) if the file is aligned to pieces.
+        padding = result['pads'][index]
+        if padding > 0:
+            info_files.append({
+                              'attr':   'p',
+                              'length': padding,
+                              'path':   ['.pad', str(padding)]
+                              })
 
-        with open(path, "rb") as fh:
-            while True:
-                filedata = fh.read(piece_length)
+    # Build the final dictionary.
+    info = {
+           'pieces': result['pieces'],
+           'name':   os.path.basename(directory.strip("/\\")),
+           'files':  info_files
+           }
+
+    return info
+
+def _next_power_of_two(n):
+    """Return the smallest power of two >= n (n >= 1)."""
+    return 1 << (n - 1).bit_length()
 
-                if len(filedata) == 0:
+def _merkle_root(hashes, count, pad):
+    """
+    Return the root of the SHA-256 merkle tree with the given leaf hashes,
+    padded with pad hashes to count leaves (a power of two).
+    """
+    layer = list(hashes) + [pad] * (count - len(hashes))
+
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest()
+                 for i in range(0, len(layer), 2)]
+
+    return layer[0]
+
+def _hash_file_v2(path, piece_length, v1=False, pad=False, include_md5=False,
+                  read_size=READ_SIZE, drop_cache=False, max_read_rate=None,
+                  include_sha256=False):
+    """
+    Hash a single file for a BitTorrent v2 (or hybrid) torrent.
+
+    Return dictionary with the following keys:
+      - length:      size of the file in bytes
+      - pieces root: root of the file's merkle tree (None if empty)
+      - piece layer: concatenated hashes of the tree's layer of pieces
+                     (None unless the file is larger than piece_length)
+      - pieces:      concatenated 20-byte-sha1-hashes of the file's pieces
+                     (None unless v1). If pad, the last piece is padded with
+                     zeros as if it was followed by a BEP 47 padding file.
+      - md5sum:      md5sum of the file (None unless include_md5)
+      - sha256sum:   SHA-256 sum of the file in hex (None unless
+                     include_sha256)
+
+    drop_cache and max_read_rate are as for hash_files(), but the rate is
+    only limited while this file is read.
+
+    This is a module level function, so it can be run in a process pool.
+    """
+    blocks_per_piece = piece_length // BLOCK_SIZE
+
+    # The hashes of a piece whose blocks are beyond the end of the file.
+    pad_piece = _merkle_root([], blocks_per_piece, bytes(32))
+
+    layer     = []
+    v1_pieces = bytearray() if v1 else None
+    md5       = hashlib.md5() if include_md5 else None
+    sha256    = hashlib.sha256() if include_sha256 else None
+    length    = 0
+
+    # Read whole pieces at a time.
+    buffer = bytearray(max(read_size - read_size % piece_length, piece_length))
+    view   = memoryview(buffer)
+
+    limiter = None
+    if max_read_rate is not None:
+        limiter = RateLimiter(max_read_rate)
+
+    with open(path, "rb", buffering=0) as fh:
+        _fadvise(fh.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+
+        while True:
+            n = 0
+            while n < len(buffer):
+                _n = fh.readinto(view[n:])
+                if not _n:
                     break
+                n += _n
 
-                length += len(filedata)
+            if n == 0:
+                break
 
-                data += filedata
+            if drop_cache:
+                _fadvise(fh.fileno(), length, n, "POSIX_FADV_DONTNEED")
 
-                if len(data) >= piece_length:
-                    info_pieces  +=  sha1_20(data[:piece_length])
-                    data          =  data[piece_length:]
+            if limiter is not None:
+                limiter.consume(n)
 
-                if include_md5:
-                    md5.update(filedata)
+            length += n
+
+            if include_md5:
+                md5.update(view[:n])
+
+            if include_sha256:
+                sha256.update(view[:n])
+
+            for offset in range(0, n, piece_length):
+                piece  = view[offset:min(offset + piece_length, n)]
+                leaves = [hashlib.sha256(piece[i:i + BLOCK_SIZE]).digest()
+                          for i in range(0, len(piece), BLOCK_SIZE)]
+
+                layer.append(_merkle_root(leaves, blocks_per_piece,
+                                          bytes(32)))
+
+                if v1:
+                    m = hashlib.sha1(piece)
+                    if pad:
+                        m.update(bytes(piece_length - len(piece)))
+                    v1_pieces += m.digest()
+
+            if n < len(buffer):
+                break
+
+    if length == 0:
+        root = None
+    elif length <= piece_length:
+        # The tree is only as large as the file's blocks require.
+        root = _merkle_root(leaves, _next_power_of_two(len(leaves)), bytes(32))
+    else:
+        root = _merkle_root(layer, _next_power_of_two(len(layer)), pad_piece)
+
+    return {
+           'length':      length,
+           'pieces root': root,
+           'piece layer': b"".join(layer) if length > piece_length else None,
+           'pieces':      v1_pieces,
+           'md5sum':      md5.hexdigest() if include_md5 else None,
+           'sha256sum':   sha256.hexdigest() if include_sha256 else None
+           }
+
+def create_v2_info(node, files, piece_length, hybrid=False, include_md5=False,
+                   workers=1, read_size=READ_SIZE, drop_cache=False,
+                   max_read_rate=None, sha256sums=None):
+    """
+    Return a tuple (info, piece_layers) for a BitTorrent v2 torrent or, if
+    hybrid, for a torrent that is valid for both v1 and v2.
+
+    node is a file, or the directory containing the given files (paths
+    relative to it). For a single file, files must be None.
+
+    info is a dictionary with the following keys:
+      - meta version: 2
+      - name:         basename of the file or directory
+      - file tree:    nested dictionaries, one level per path component,
+                      where the key '' of each file maps to a dictionary
+                      with the following keys:
+        - length:      size of the file in bytes
+        - pieces root: root of the file's merkle tree (unless empty)
+    and additionally for hybrid torrents:
+      - pieces:       concatenated 20-byte-sha1-hashes
+      - length:       size of the file in bytes (single file only)
+      - files:        list of the files as in create_multi_file_info(),
+                      ordered like the file tree and with BEP 47 padding
+                      files (attr 'p') between them, so that every file
+                      starts on a piece boundary.
+
+    piece_layers maps the pieces roots of all files larger than
+    piece_length to the concatenated hashes of their pieces.
+
+    Every file's merkle tree is independent of the others, thus the files
+    are hashed by the given number of processes. drop_cache and
+    max_read_rate are as for hash_files(), the rate being shared by the
+    processes.
+
+    If a dictionary is given as sha256sums, the files' SHA-256 sums (in
+    hex) are stored in it, by the file's path as given (or the basename
+    for a single file). They are calculated from the same data as the
+    torrent.
+
+    @see:   BEP 52 (v2 and hybrid torrents), BEP 47 (padding files).
+    """
+    if piece_length < BLOCK_SIZE or piece_length & (piece_length - 1):
+        raise ValueError("piece length must be a power of two and at least "
+                         "16 KiB (given: %d)" % piece_length)
+
+    if files is None:
+        assert os.path.isfile(node), "not a file"
+
+        paths = [node]
+        parts = [[os.path.basename(node)]]
+    else:
+        assert os.path.isdir(node), "not a directory"
+
+        # The v1 files of hybrid torrents must be in the order of the file
+        # tree, whose keys are sorted as raw byte strings.
+        if hybrid:
+            files = sorted(files, key=lambda file: [part.encode("utf-8")
+                                                    for part in
+                                                    split_path(file)])
+
+        paths = [os.path.join(node, file) for file in files]
+        parts = [split_path(file) for file in files]
+
+    # All files but the last are padded in hybrid torrents.
+    pads  = [hybrid and index < len(paths) - 1 for index in range(len(paths))]
+
+    args = (paths,
+            itertools.repeat(piece_length),
+            itertools.repeat(hybrid),
+            pads,
+            itertools.repeat(hybrid and include_md5),
+            itertools.repeat(read_size),
+            itertools.repeat(drop_cache),
+            itertools.repeat(max_read_rate and max_read_rate / workers),
+            itertools.repeat(sha256sums is not None))
+
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(_hash_file_v2, *args,
+                                        chunksize=V2_CHUNKSIZE))
+    else:
+        results = list(map(_hash_file_v2, *args))
+
+    file_tree    = {}
+    piece_layers = {}
+    info_files   = []
+    info_pieces  = bytearray()
+
+    if sha256sums is not None:
+        for file, result in zip(files or [os.path.basename(node)], results):
+            sha256sums[file] = result['sha256sum']
+
+    for path, result, pad in zip(parts, results, pads):
+        # Build the file's entry of the file tree.
+        node_dict = file_tree
+        for part in path:
+            node_dict = node_dict.setdefault(part, {})
+
+        node_dict[''] = {'length': result['length']}
+
+        if result['pieces root'] is not None:
+            node_dict['']['pieces root'] = result['pieces root']
+
+        if result['piece layer'] is not None:
+            piece_layers[result['pieces root']] = result['piece layer']
+
+        if not hybrid:
+            continue
+
+        info_pieces += result['pieces']
 
-        # Build the current file's dictionary.
         fdict = {
-                'length': length,
-                'path':   split_path(file)
+                'length': result['length'],
+                'path':   path
                 }
 
         if include_md5:
-            fdict['md5sum'] = md5.hexdigest()
+            fdict['md5sum'] = result['md5sum']
 
         info_files.append(fdict)
 
-    # Don't forget to hash the last piece.
-    # (Probably the piece that has not reached the regular piece size.)
-    if len(data) > 0:
-        info_pieces += sha1_20(data)
+        padding = -result['length'] % piece_length
+        if pad and padding > 0:
+            info_files.append({
+                              'attr':   'p',
+                              'length': padding,
+                              'path':   ['.pad', str(padding)]
+                              })
 
-    # Build the final dictionary.
     info = {
-           'pieces': info_pieces,
-           'name':   os.path.basename(directory.strip("/\\")),
-           'files':  info_files
+           'meta version': 2,
+           'name':         parts[0][0] if files is None else
+                           os.path.basename(node.strip("/\\")),
+           'file tree':    file_tree
            }
 
-    return info
+    if hybrid:
+        info['pieces'] = info_pieces
+
+        if files is None:
+            info['length'] = results[0]['length']
+
+            if include_md5:
+                info['md5sum'] = results[0]['md5sum']
+        else:
+            info['files'] = info_files
+
+    return info, piece_layers
+
+class _Exclusions(object):
+    """
+    Matcher for the paths excluded from get_files_in_directory().
+
+    The excluded paths are held in a trie of their os.path.normcase()-d
+    components, so the entries of a directory are only looked up if any
+    excluded path lies below it. The regular expressions are combined into
+    one alternation, so every path is searched only once. Regular
+    expressions that cannot be combined (e.g. because of backreferences
+    or global flags) are searched one by one.
+    """
+    # Flags that can be applied to part of a regular expression.
+    SCOPED_FLAGS = {
+                   re.IGNORECASE: "i",
+                   re.MULTILINE:  "m",
+                   re.DOTALL:     "s",
+                   re.VERBOSE:    "x"
+                   }
+
+    def __init__(self, paths, regexps):
+        self.trie = {}
+        for path in paths:
+            node = self.trie
+            for part in path.split(os.sep):
+                node = node.setdefault(part, {})
+            # The key None marks an excluded path.
+            node[None] = True
+
+        self.regexps = []
+        combined     = []
+
+        for regexp in regexps:
+            pattern = self._scoped_pattern(regexp)
+            if pattern is None:
+                self.regexps.append(regexp)
+            else:
+                combined.append(pattern)
+
+        if combined:
+            try:
+                self.regexps.append(re.compile("|".join(combined)))
+            except re.error:
+                self.regexps.extend(regexps)
+
+    @classmethod
+    def _scoped_pattern(cls, regexp):
+        # Return the pattern as non-capturing group with the regexp's flags,
+        # or None if it is not safe to combine it with others.
+        if not isinstance(regexp.pattern, str) or regexp.groupindex or \
+           re.search(r"\\[1-9]|\(\?[aiLmsux]+\)", regexp.pattern):
+            return None
+
+        flags = ""
+        for flag, letter in cls.SCOPED_FLAGS.items():
+            if regexp.flags & flag:
+                flags += letter
+
+        # Any other flags (apart from the default re.UNICODE) prevent
+        # combining.
+        other = regexp.flags & ~re.UNICODE
+        for flag in cls.SCOPED_FLAGS:
+            other &= ~flag
+        if other:
+            return None
+
+        if flags:
+            return "(?%s:%s)" % (flags, regexp.pattern)
+        return "(?:%s)" % regexp.pattern
+
+    def root(self, directory):
+        """
+        Return the trie node of the given (absolute) directory, or None if
+        no excluded path lies below it.
+        """
+        node = self.trie
+        for part in os.path.normcase(directory).split(os.sep):
+            node = node.get(part)
+            if node is None:
+                break
+        return node
+
+    def match(self, path, name, node):
+        """
+        Return a tuple (excluded, child), where child is the trie node of
+        the entry with the given path and name within the directory
+        belonging to the given trie node.
+        """
+        child = None
+        if node is not None:
+            child = node.get(os.path.normcase(name))
+            if child is not None and None in child:
+                return True, child
+
+        for regexp in self.regexps:
+            if regexp.search(path):
+                return True, child
+
+        return False, child
+
+def write_sha256sums(path, sha256sums, files=None):
+    """
+    Write a checksum manifest in the format of sha256sum, which can be
+    checked with "sha256sum -c" from the directory containing the files.
+
+    sha256sums maps the files' paths to their SHA-256 sums in hex, as
+    filled by create_multi_file_info() and friends. files gives the order
+    of the files (default: the order of sha256sums).
+    """
+    if files is None:
+        files = list(sha256sums)
+
+    with open(path, "w", encoding="utf-8", newline="\n") as fh:
+        for file in files:
+            name = file.replace(os.sep, "/")
+
+            # Like sha256sum, escape backslashes and newlines in names.
+            if "\\" in name or "\n" in name:
+                name = name.replace("\\", "\\\\").replace("\n", "\\n")
+                fh.write("\\%s  %s\n" % (sha256sums[file], name))
+            else:
+                fh.write("%s  %s\n" % (sha256sums[file], name))
 
 def get_files_in_directory(directory,
                            excluded_paths=set(),
                            relative_to=None,
-                           excluded_regexps=set()):
+                           excluded_regexps=set(),
+                           with_stat=False,
+                           workers=1):
     """
     Return a list containing the paths to all files in the given directory.
 
@@ -193,8 +2240,26 @@ def get_files_in_directory(directory,
     The paths may be returned relative to a specific directory. By default,
     this is the initial directory itself.
 
+    With with_stat=True, tuples (path, stat_result) are returned instead,
+    so the caller does not have to stat the files again.
+
     Please note: Only paths to files are returned!
-    
+
+    The directory is walked with os.scandir() and every entry is stat()-ed
+    only once. Directories that have already been walked (symlink loops)
+    are skipped, detected by (st_dev, st_ino). So are files whose real path
+    has already been listed (symlinks to listed files and the targets of
+    listed symlinks), while hardlinks are listed as separate files.
+
+    Excluded directories are not listed at all. See _Exclusions for how
+    the exclusions are matched.
+
+    With workers > 1, the subdirectories are listed and stat()-ed ahead by
+    that many threads, which helps on filesystems with a high latency
+    (e.g. NFS). At most 2 * workers listings are kept ahead of the walk,
+    taken in the order the walk is going to need them. The result is the
+    same as with a single thread.
+
     @param excluded_regexps: A set or frozenset of compiled regular expressions.
     """
     # Argument validation:
@@ -215,55 +2280,61 @@ def get_files_in_directory(directory,
     if not isinstance(excluded_regexps, (set, frozenset)):
         raise TypeError("excluded_regexps must be instance of: set or frozenset")
 
-    # Helper function:
-    def _get_files_in_directory(directory,
-                                files,
-                                excluded_paths=set(),
-                                relative_to=None,
-                                excluded_regexps=set(),
-                                processed_paths=set()):
+    # Helper functions:
+    def _list(directory, node):
+        # Return a list of tuples (entry, stat_result, node) for the
+        # directory's entries that are not excluded, where stat_result is
+        # None for broken symlinks etc. and node is the entry's node of the
+        # exclusion trie.
         # Improve consistency across platforms.
-        # Note:
-        listdir = os.listdir(directory)
-        listdir.sort(key=str.lower)
+        with os.scandir(directory) as it:
+            entries = list(it)
+        entries.sort(key=lambda entry: entry.name.lower())
+
+        listing = []
+        for entry in entries:
+            excluded, child = exclusions.match(entry.path, entry.name, node)
+            if excluded:
+                continue
 
-        processed_paths.add(os.path.normcase(os.path.realpath(directory)))
+            try:
+                st = entry.stat()
+            except OSError:
+                st = None
 
-        for node in listdir:
-            path = os.path.join(directory, node)
+            listing.append((entry, st, child))
 
-            if os.path.normcase(path) in excluded_paths:
-                continue
+        return listing
 
-            regexp_match = False
-            for regexp in excluded_regexps:
-                if regexp.search(path):
-                    regexp_match = True
-                    break
-            if regexp_match:
-                continue
+    def _get_listing(directory, node):
+        # Return an iterator over the directory's listing, listed ahead or
+        # now, and list its subdirectories ahead.
+        future  = listings.pop(directory, None)
+        listing = _list(directory, node) if future is None else \
+                  future.result()
 
-            if os.path.normcase(os.path.realpath(path)) in processed_paths:
-                print("Warning: skipping symlink '%s', because it's target "
-                      "has already been processed." % path, file=sys.stderr)
-                continue
-            processed_paths.add(os.path.normcase(os.path.realpath(path)))
-
-            if os.path.isfile(path):
-                if relative_to:
-                    path = os.path.relpath(path, relative_to)
-                files.append(path)
-            elif os.path.isdir(path):
-                _get_files_in_directory(path,
-                                        files,
-                                        excluded_paths=excluded_paths,
-                                        relative_to=relative_to,
-                                        excluded_regexps=excluded_regexps,
-                                        processed_paths=processed_paths)
-            else:
-                assert False, "not a valid node: '%s'" % node
+        if executor is not None:
+            # The subdirectories are walked right after the directory, so
+            # they go on top of the directories to list ahead.
+            subdirs = []
+            for entry, st, child in listing:
+                if st is None or not stat.S_ISDIR(st.st_mode) or \
+                   (st.st_dev, st.st_ino) in prefetched:
+                    continue
 
-        return files
+                prefetched.add((st.st_dev, st.st_ino))
+                subdirs.append((entry.path, child, (st.st_dev, st.st_ino)))
+
+            ahead.extend(reversed(subdirs))
+
+            while ahead and len(listings) < 2 * workers:
+                path, child, key = ahead.pop()
+
+                # Not if the walk has got there first.
+                if key not in processed_dirs:
+                    listings[path] = executor.submit(_list, path, child)
+
+        return iter(listing)
 
     # Final preparations:
     directory = os.path.abspath(directory)
@@ -271,12 +2342,75 @@ def get_files_in_directory(directory,
     if not relative_to:
         relative_to = directory
 
+    st = os.stat(directory)
+
+    exclusions = _Exclusions(excluded_paths, excluded_regexps)
+    root       = exclusions.root(directory)
+
+    # Identities of the directories walked and of the files listed, the
+    # latter with the paths they were listed by.
+    processed_dirs  = {(st.st_dev, st.st_ino)}
+    processed_files = {}
+
+    # Listings ahead of the walk, as futures by path, the directories to
+    # list ahead next (the next one last) and the identities of those
+    # directories and of those already listed ahead.
+    executor   = None
+    listings   = {}
+    ahead      = []
+    prefetched = {(st.st_dev, st.st_ino)}
+
+    if workers > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(workers)
+
     # Now do the main work.
-    files = _get_files_in_directory(directory,
-                                    list(),
-                                    excluded_paths=excluded_paths,
-                                    relative_to=relative_to,
-                                    excluded_regexps=excluded_regexps)
+    files = []
+
+    try:
+        stack = [_get_listing(directory, root)]
+
+        while stack:
+            entry, st, node = next(stack[-1], (None, None, None))
+            if entry is None:
+                stack.pop()
+                continue
+
+            path = entry.path
+
+            if st is not None and stat.S_ISREG(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+
+                # The same file again: a symlink (to it or from it) or a
+                # hardlink, only the former have the same real path.
+                if key in processed_files:
+                    realpath = os.path.normcase(os.path.realpath(path))
+                    if any(os.path.normcase(os.path.realpath(other)) ==
+                           realpath for other in processed_files[key]):
+                        print("Warning: skipping symlink '%s', because it's "
+                              "target has already been processed." % path,
+                              file=sys.stderr)
+                        continue
+
+                processed_files.setdefault(key, []).append(path)
+
+                path = os.path.relpath(path, relative_to)
+                files.append((path, st) if with_stat else path)
+            elif st is not None and stat.S_ISDIR(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+
+                if key in processed_dirs:
+                    print("Warning: skipping symlink '%s', because it's "
+                          "target has already been processed." % path,
+                          file=sys.stderr)
+                    continue
+
+                processed_dirs.add(key)
+                stack.append(_get_listing(path, node))
+            else:
+                assert False, "not a valid node: '%s'" % entry.name
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
 
     return files
 
@@ -464,6 +2598,95 @@ def main(argv):
                       dest="include_md5", default=False,
                       help="include MD5 hashes in torrent file")
 
+    parser.add_option("--sha256sums", type="string", action="store",
+                      dest="sha256sums", default=None, metavar="PATH",
+                      help="also write the SHA-256 sums of the files to "
+                           "PATH, in the format of sha256sum. The files "
+                           "are still read only once.")
+
+    parser.add_option("--meta-version", type="choice", action="store",
+                      dest="meta_version", default="1",
+                      choices=["1", "2", "hybrid"],
+                      help="create a BitTorrent v1 (default), v2 or hybrid "
+                           "torrent. v2 and hybrid torrents hash the files "
+                           "in parallel processes (see --workers).")
+
+    parser.add_option("-w", "--workers", type="int", action="store",
+                      dest="workers", default=1, metavar="N",
+                      help="number of threads (v1) or processes (v2, "
+                           "hybrid) used for hashing. default = 1.")
+
+    parser.add_option("--scan-workers", type="int", action="store",
+                      dest="scan_workers", default=1, metavar="N",
+                      help="number of threads listing the directories. "
+                           "More threads help on network filesystems. "
+                           "default = 1.")
+
+    parser.add_option("--read-size", type="int", action="store",
+                      dest="read_size", default=READ_SIZE // MIB,
+                      metavar="MIB",
+                      help="read the files this many MiB at a time, "
+                           "independent of the piece size. default = %d."
+                           % (READ_SIZE // MIB))
+
+    parser.add_option("--queue-depth", type="int", action="store",
+                      dest="queue_depth", default=PREFETCH_DEPTH, metavar="N",
+                      help="number of small files (up to %d MiB) read "
+                           "ahead concurrently. 0 = disabled. default = %d."
+                           % (SMALL_FILE_SIZE // MIB, PREFETCH_DEPTH))
+
+    parser.add_option("--io-depth", type="int", action="store",
+                      dest="io_depth", default=1, metavar="N",
+                      help="number of reads of large files in flight. "
+                           "Parallel storage may need more than one to "
+                           "reach its bandwidth. default = 1.")
+
+    parser.add_option("--no-cache-pollution", action="store_true",
+                      dest="drop_cache", default=False,
+                      help="drop the files from the page cache once they "
+                           "have been read, so the data cached for other "
+                           "processes (e.g. seeding) is not evicted")
+
+    parser.add_option("--max-read-rate", type="float", action="store",
+                      dest="max_read_rate", default=None, metavar="MIB",
+                      help="read at most this many MiB per second")
+
+    parser.add_option("--hash-cache", type="string", action="store",
+                      dest="hash_cache", default=None, metavar="PATH",
+                      help="reuse the piece hashes of unchanged files from "
+                           "this cache database (created if necessary)")
+
+    parser.add_option("--hash-cache-size", type="int", action="store",
+                      dest="hash_cache_size", default=1024, metavar="MIB",
+                      help="evict the least recently used entries of the "
+                           "hash cache beyond this size in MiB. "
+                           "default = 1024.")
+
+    parser.add_option("--checkpoint-interval", type="int", action="store",
+                      dest="checkpoint_interval",
+                      default=CHECKPOINT_INTERVAL, metavar="SECONDS",
+                      help="write the hashing progress to <output>.journal "
+                           "at this interval. 0 = disabled. default = %d."
+                           % CHECKPOINT_INTERVAL)
+
+    parser.add_option("--align-files", action="store_true",
+                      dest="align_files", default=False,
+                      help="start every file on a piece boundary by adding "
+                           "padding files (BEP 47), so that its piece hashes "
+                           "only depend on its content")
+
+    parser.add_option("--update", type="string", action="store",
+                      dest="update", default=None, metavar="TORRENT",
+                      help="keep the piece hashes of an existing torrent for "
+                           "a directory that has only gained files (at the "
+                           "end) since, and hash only the new data")
+
+    parser.add_option("--resume", action="store_true",
+                      dest="resume", default=False,
+                      help="continue hashing from the last checkpoint in "
+                           "<output>.journal, if the files hashed before it "
+                           "are unchanged")
+
     (options, args) = parser.parse_args(args = argv[1:])
 
     # Positional arguments must have been provided:
@@ -519,36 +2742,220 @@ def main(argv):
             print("Warning: You're excluding a path that does not exist: '%s'"
                   % path, file=sys.stderr)
 
+    if options.scan_workers < 1:
+        parser.error("Invalid number of scan workers: '%d'"
+                     % options.scan_workers)
+
     # Get the torrent's files and / or calculate its size.
     if os.path.isfile(node):
         torrent_size = os.path.getsize(node)
     else:
         torrent_files = get_files_in_directory(node,
                                          excluded_paths=excluded_paths,
-                                         excluded_regexps=excluded_regexps)
-        torrent_size = sum([os.path.getsize(os.path.join(node, file))
-                            for file in torrent_files])
+                                         excluded_regexps=excluded_regexps,
+                                         with_stat=True,
+                                         workers=options.scan_workers)
+        torrent_stats = [st for _, st in torrent_files]
+        torrent_files = [file for file, _ in torrent_files]
+        torrent_size  = sum([st.st_size for st in torrent_stats])
 
     # Torrents for 0 byte data can't be created.
     if torrent_size == 0:
         raise Exception("No data for torrent.")
 
+    if options.workers < 1:
+        parser.error("Invalid number of workers: '%d'" % options.workers)
+
+    if options.read_size < 1:
+        parser.error("Invalid read size: '%d'" % options.read_size)
+
+    if options.io_depth < 1:
+        parser.error("Invalid I/O depth: '%d'" % options.io_depth)
+
+    if options.queue_depth < 0:
+        parser.error("Invalid queue depth: '%d'" % options.queue_depth)
+
+    if options.max_read_rate is not None and options.max_read_rate <= 0:
+        parser.error("Invalid read rate: '%s'" % options.max_read_rate)
+
+    max_read_rate = None
+    if options.max_read_rate is not None:
+        max_read_rate = options.max_read_rate * MIB
+
+    if options.meta_version != "1":
+        if options.update or options.resume or options.hash_cache or \
+           options.align_files:
+            parser.error("--update, --resume, --hash-cache and --align-files "
+                         "are only supported for v1 torrents. (Hybrid "
+                         "torrents are always aligned.)")
+
+        if options.include_md5 and options.meta_version == "2":
+            parser.error("MD5 hashes are only supported for v1 and hybrid "
+                         "torrents.")
+
+    # Check which part of the torrent to update is still valid.
+    if options.update:
+        if os.path.isfile(node):
+            parser.error("Only torrents for directories can be updated.")
+
+        try:
+            with open(options.update, "rb") as fh:
+                old_metainfo = bdecode(fh.read(), decode_strings=False)
+            old_piece_length = old_metainfo[b'info'][b'piece length']
+        except (IOError, DecodingException, KeyError, TypeError) as exc:
+            parser.error("Cannot read '%s': %s" % (options.update, exc))
+
+        if options.piece_length not in (0, old_piece_length // KIB):
+            parser.error("The piece size must be the same as in '%s' (%d KiB)."
+                         % (options.update, old_piece_length // KIB))
+
+        try:
+            prefix = get_update_prefix(old_metainfo, node, torrent_files,
+                                       align_files=options.align_files)
+        except ValueError as exc:
+            parser.error("Cannot update '%s': %s" % (options.update, exc))
+    else:
+        prefix = None
+
     # Calculate or parse the piece size.
-    if options.piece_length == 0:
+    if options.update:
+        piece_length = old_piece_length
+    elif options.piece_length == 0:
         piece_length = calculate_piece_length(torrent_size)
     elif options.piece_length > 0:
         piece_length = options.piece_length * KIB
     else:
         parser.error("Invalid piece size: '%d'" % options.piece_length)
 
+    if options.meta_version != "1" and \
+       (piece_length < BLOCK_SIZE or piece_length & (piece_length - 1)):
+        parser.error("The piece size of v2 and hybrid torrents must be a "
+                     "power of two of at least 16 KiB: '%d'"
+                     % options.piece_length)
+
+    if options.checkpoint_interval < 0:
+        parser.error("Invalid checkpoint interval: '%d'"
+                     % options.checkpoint_interval)
+
+    if options.hash_cache_size < 0:
+        parser.error("Invalid hash cache size: '%d'" % options.hash_cache_size)
+
+    # ##################################
+    # DETERMINE THE TORRENT'S FILE NAME:
+    # - validate the --name option
+    # - take into consideration the --output option
+
+    # The name defaults to the name of directory or file the torrent
+    # is being created for.
+    if options.name:
+        options.name = options.name.strip()
+
+        regexp = re.compile("^[A-Z0-9_\-\., ]+$", re.I)
+
+        if not regexp.match(options.name):
+            parser.error("Invalid name: '%s'. Allowed chars: A_Z, a-z, 0-9, "
+                         "any of {.,_-} plus spaces." % options.name)
+
+        name = options.name
+    else:
+        name = os.path.basename(node)
+
+    # Respect the custom output location.
+    if not options.output:
+        # Use current directory.
+        output_path = name + ".torrent"
+
+    else:
+        # Use the directory or filename specified by the user.
+        options.output = os.path.abspath(options.output)
+
+        # The user specified an output directory:
+        if os.path.isdir(options.output):
+            output_path = os.path.join(options.output,
+                                       name + ".torrent")
+            if os.path.isfile(output_path):
+                if not options.force and os.path.exists(output_path):
+                    if "yes" != input("'%s' does already exist. Overwrite? "
+                                      "yes/no: " % output_path):
+                        parser.error("Aborted.")
+
+        # The user specified a filename:
+        else:
+            # Is there already a file with this path? -> overwrite?!
+            if os.path.isfile(options.output):
+                if not options.force and os.path.exists(options.output):
+                    if "yes" != input("'%s' does already exist. Overwrite? "
+                                      "yes/no: " % options.output):
+                        parser.error("Aborted.")
+
+            output_path = options.output
+
+    # Checkpoints of the hashing progress are written next to the torrent.
+    if options.checkpoint_interval > 0 and options.meta_version == "1":
+        journal_path = output_path + ".journal"
+    else:
+        journal_path = None
+
+    if options.hash_cache:
+        cache = HashCache(options.hash_cache, options.hash_cache_size * MIB)
+    else:
+        cache = None
+
     # Do the main work now.
     # -> prepare the metainfo dictionary.
-    if os.path.isfile(node):
-        info = create_single_file_info(node, piece_length, options.include_md5)
-    else:
-        info = create_multi_file_info(node, torrent_files, piece_length, options.include_md5)
+    hash_options = {
+                   'workers':             options.workers,
+                   'read_size':           options.read_size * MIB,
+                   'prefetch_depth':      options.queue_depth,
+                   'io_depth':            options.io_depth,
+                   'drop_cache':          options.drop_cache,
+                   'max_read_rate':       max_read_rate,
+                   'cache':               cache,
+                   'journal':             journal_path,
+                   'resume':              options.resume,
+                   'checkpoint_interval': options.checkpoint_interval,
+                   'prefix':              prefix
+                   }
+
+    # Aligning a single file makes no difference.
+    if os.path.isdir(node):
+        hash_options['align_files'] = options.align_files
+        hash_options['stats']       = torrent_stats
+
+    sha256sums = None
+    if options.sha256sums:
+        sha256sums = hash_options['sha256sums'] = {}
+
+    piece_layers = None
 
-    assert len(info['pieces']) % 20 == 0, "len(pieces) not a multiple of 20"
+    try:
+        if options.meta_version != "1":
+            info, piece_layers = create_v2_info(
+                node,
+                None if os.path.isfile(node) else torrent_files,
+                piece_length,
+                hybrid=options.meta_version == "hybrid",
+                include_md5=options.include_md5,
+                workers=options.workers,
+                read_size=options.read_size * MIB,
+                drop_cache=options.drop_cache,
+                max_read_rate=max_read_rate,
+                sha256sums=sha256sums)
+        elif os.path.isfile(node):
+            info = create_single_file_info(node, piece_length,
+                                           options.include_md5,
+                                           **hash_options)
+        else:
+            info = create_multi_file_info(node, torrent_files, piece_length,
+                                          options.include_md5,
+                                          **hash_options)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if 'pieces' in info:
+        assert len(info['pieces']) % 20 == 0, \
+               "len(pieces) not a multiple of 20"
 
     # ###########################
     # FINISH METAINFO DICTIONARY:
@@ -557,6 +2964,7 @@ def main(argv):
     #   - name (eventually overwrite)
     #   - private
     # - announce
+    # - piece layers (v2 and hybrid only)
     # - announce-list (if multiple trackers)
     # - creation date (may be disabled as well)
     # - created by
@@ -574,6 +2982,9 @@ def main(argv):
                 'announce':       'http://academictorrents.com/announce.php',
                 }
 
+    if piece_layers is not None:
+        metainfo['piece layers'] = piece_layers
+
     # Set "creation date".
     # The user may specify a custom creation date. He may also decide not
     # to include the creation date field at all.
@@ -599,56 +3010,19 @@ def main(argv):
     # By default this is the name of directory or file the torrent
     # is being created for.
     if options.name:
-        options.name = options.name.strip()
-
-        regexp = re.compile("^[A-Z0-9_\-\., ]+$", re.I)
-
-        if not regexp.match(options.name):
-            parser.error("Invalid name: '%s'. Allowed chars: A_Z, a-z, 0-9, "
-                         "any of {.,_-} plus spaces." % options.name)
-
         metainfo['info']['name'] = options.name
 
+        # The file tree of single file v2 torrents is keyed by the file name.
+        if 'file tree' in info and os.path.isfile(node):
+            info['file tree'] = {options.name: info['file tree'].popitem()[1]}
+
     # ###################################################
     # BENCODE METAINFO DICTIONARY AND WRITE TORRENT FILE:
-    # - take into consideration the --output option
     # - properly handle KeyboardInterrups while writing the file
 
-    # Respect the custom output location.
-    if not options.output:
-        # Use current directory.
-        output_path = metainfo['info']['name'] + ".torrent"
-
-    else:
-        # Use the directory or filename specified by the user.
-        options.output = os.path.abspath(options.output)
-
-        # The user specified an output directory:
-        if os.path.isdir(options.output):
-            output_path = os.path.join(options.output,
-                                       metainfo['info']['name']+".torrent")
-            if os.path.isfile(output_path):
-                if not options.force and os.path.exists(output_path):
-                    if "yes" != input("'%s' does already exist. Overwrite? "
-                                      "yes/no: " % output_path):
-                        parser.error("Aborted.")
-
-        # The user specified a filename:
-        else:
-            # Is there already a file with this path? -> overwrite?!
-            if os.path.isfile(options.output):
-                if not options.force and os.path.exists(options.output):
-                    if "yes" != input("'%s' does already exist. Overwrite? "
-                                      "yes/no: " % options.output):
-                        parser.error("Aborted.")
-
-            output_path = options.output
-
-
     # Actually write the torrent file now.
     try:
-        with open(output_path, "wb") as fh:
-            fh.write(bencode(metainfo))
+        write_bencoded(output_path, metainfo)
     except IOError as exc:
         print("IOError: " + str(exc), file=sys.stderr)
         print("Could not write the torrent file. Check torrent name and your "
@@ -657,8 +3031,628 @@ def main(argv):
               file=sys.stderr)
         return 1
     except KeyboardInterrupt:
-        # Properly handle KeyboardInterrupts.
-        # todo: open()'s context manager may already do this on his own?
-        if os.path.exists(output_path):
-            os.remove(output_path)
+        # write_bencoded() does not leave an incomplete file behind.
+        return 1
+
+    # Write the checksum manifest.
+    if sha256sums is not None:
+        try:
+            write_sha256sums(options.sha256sums, sha256sums,
+                             torrent_files if os.path.isdir(node) else None)
+        except IOError as exc:
+            print("IOError: " + str(exc), file=sys.stderr)
+            print("Could not write the SHA-256 sums.", file=sys.stderr)
+            return 1
+
+    # The torrent is complete, there is nothing left to resume.
+    if journal_path is not None:
+        for path in _Journal.paths(journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+
     return 0
+
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sys.exit(main(sys.argv))
+
+    ##################
+    # RUN UNIT TESTS #
+    import shutil
+    import tempfile
+    import unittest
+    from py3bencode import bencode
+
+    PIECE_LENGTH = 16384
+
+    class _Stop(Exception):
+        """Raised by a progress callback to interrupt hash_files()."""
+        pass
+
+    class _CountingCache(HashCache):
+        """A HashCache counting its hits."""
+        hits = 0
+
+        def get(self, key):
+            entry = super().get(key)
+            if entry is not None:
+                self.hits += 1
+            return entry
+
+    def _merkle(hashes, count, pad):
+        # The root of a merkle tree of count leaves, padded with pad.
+        layer = list(hashes) + [pad] * (count - len(hashes))
+        while len(layer) > 1:
+            layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest()
+                     for i in range(0, len(layer), 2)]
+        return layer[0]
+
+    def _v2_hashes(path, piece_length):
+        # The pieces root and piece layer of a file, straight from BEP 52.
+        with open(path, "rb") as fh:
+            data = fh.read()
+        if not data:
+            return None, None
+
+        leaves = [hashlib.sha256(data[pos:pos + BLOCK_SIZE]).digest()
+                  for pos in range(0, len(data), BLOCK_SIZE)]
+        if len(data) <= piece_length:
+            return _merkle(leaves, 1 << (len(leaves) - 1).bit_length(),
+                           bytes(32)), None
+
+        per_piece = piece_length // BLOCK_SIZE
+        layer     = [_merkle(leaves[pos:pos + per_piece], per_piece, bytes(32))
+                     for pos in range(0, len(leaves), per_piece)]
+        return (_merkle(layer, 1 << (len(layer) - 1).bit_length(),
+                        _merkle([], per_piece, bytes(32))),
+                b"".join(layer))
+
+    def _old_listing(directory, excluded_paths=frozenset(),
+                     excluded_regexps=frozenset()):
+        # The files found by get_files_in_directory() before it used
+        # os.scandir(), inode numbers and _Exclusions, for comparison.
+        directory = os.path.abspath(directory)
+        files     = []
+        processed = set()
+
+        def walk(path):
+            processed.add(os.path.normcase(os.path.realpath(path)))
+
+            for name in sorted(os.listdir(path), key=str.lower):
+                entry = os.path.join(path, name)
+                if os.path.normcase(entry) in excluded_paths or \
+                   any(regexp.search(entry) for regexp in excluded_regexps):
+                    continue
+
+                real = os.path.normcase(os.path.realpath(entry))
+                if real in processed:
+                    continue
+                processed.add(real)
+
+                if os.path.isfile(entry):
+                    files.append(os.path.relpath(entry, directory))
+                elif os.path.isdir(entry):
+                    walk(entry)
+
+        walk(directory)
+        return files
+
+    class Test(unittest.TestCase):
+        """
+        The pieces and checksums calculated by hash_files() must not depend
+        on how the files are read and hashed, so every variant is compared
+        to the files hashed in one go.
+        """
+        def setUp(self):
+            self.tmp = tempfile.mkdtemp()
+            self.dir = os.path.join(self.tmp, "data")
+
+            sizes = [("empty", 0), ("one", 1), ("piece", PIECE_LENGTH),
+                     ("odd", 50001), ("big", 300000)]
+            sizes += [("many/%02d" % i, 1000 + i) for i in range(20)]
+
+            for name, size in sizes:
+                self.write(name, os.urandom(size))
+
+            # A hardlink, hashed only once if aligned like its source.
+            os.link(os.path.join(self.dir, "big"),
+                    os.path.join(self.dir, "many", "big"))
+
+            # A sparse file with data between and after its holes.
+            with open(os.path.join(self.dir, "sparse"), "wb") as fh:
+                fh.seek(100000)
+                fh.write(os.urandom(10000))
+                fh.seek(400000 - 1000)
+                fh.write(os.urandom(1000))
+
+            self.files = get_files_in_directory(self.dir)
+            self.paths = [os.path.join(self.dir, f) for f in self.files]
+
+        def tearDown(self):
+            shutil.rmtree(self.tmp)
+
+        def write(self, name, data):
+            path = os.path.join(self.dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                fh.write(data)
+
+        def expected(self, align_files=False, paths=None):
+            # The result of hashing all files in one go.
+            paths = paths or self.paths
+            data  = bytearray()
+            pads  = []
+            for index, path in enumerate(paths):
+                with open(path, "rb") as fh:
+                    content = fh.read()
+                data += content
+
+                pads.append(-len(content) % PIECE_LENGTH
+                            if align_files and index < len(paths) - 1
+                            else 0)
+                data += bytes(pads[-1])
+
+            pieces = b"".join(
+                hashlib.sha1(data[pos:pos + PIECE_LENGTH]).digest()
+                for pos in range(0, len(data), PIECE_LENGTH))
+
+            return {
+                   'pieces':     pieces,
+                   'lengths':    [os.path.getsize(p) for p in paths],
+                   'md5sums':    [self.checksum('md5', p) for p in paths],
+                   'sha256sums': None,
+                   'pads':       pads
+                   }
+
+        def checksum(self, name, path):
+            with open(path, "rb") as fh:
+                return hashlib.new(name, fh.read()).hexdigest()
+
+        def hash(self, paths=None, **options):
+            result = hash_files(paths or self.paths, PIECE_LENGTH, True,
+                                **options)
+            result['pieces'] = bytes(result['pieces'])
+            return result
+
+        def check_variants(self, variants, align_files=False):
+            expected = self.expected(align_files)
+            for options in variants:
+                self.assertEqual(expected,
+                                 self.hash(align_files=align_files,
+                                           **options), options)
+
+        def test_workers(self):
+            self.check_variants([{}, {'workers': 2}, {'workers': 3},
+                                 {'workers': 8}])
+
+        def test_info(self):
+            serial = create_multi_file_info(self.dir, self.files,
+                                            PIECE_LENGTH)
+            self.assertEqual(self.expected()['pieces'],
+                             bytes(serial['pieces']))
+            self.assertEqual(serial, create_multi_file_info(
+                self.dir, self.files, PIECE_LENGTH, workers=3))
+
+            path   = os.path.join(self.dir, "odd")
+            serial = create_single_file_info(path, PIECE_LENGTH)
+            self.assertEqual(self.expected(paths=[path])['pieces'],
+                             bytes(serial['pieces']))
+            self.assertEqual(serial, create_single_file_info(
+                path, PIECE_LENGTH, workers=3))
+
+        def test_small_reads(self):
+            # Reads smaller than a piece, also not dividing it.
+            self.check_variants([{'read_size': 4096},
+                                 {'read_size': 5000},
+                                 {'read_size': 5000, 'workers': 2},
+                                 {'read_size': 4096, 'mmap_threshold': 0}])
+
+        def test_mmap(self):
+            self.check_variants([{'mmap_threshold': 0},
+                                 {'mmap_threshold': 0, 'read_size': 4096,
+                                  'workers': 3},
+                                 {'mmap_threshold': 20000},
+                                 {'mmap_threshold': None}])
+
+        def test_cache(self):
+            expected = self.expected()
+            path     = os.path.join(self.tmp, "cache.db")
+
+            with _CountingCache(path) as cache:
+                self.assertEqual(expected, self.hash(cache=cache))
+
+            # The hashes of unchanged files are taken from the cache.
+            for options in [{}, {'workers': 3, 'read_size': 4096}]:
+                with _CountingCache(path) as cache:
+                    self.assertEqual(expected, self.hash(cache=cache,
+                                                         **options))
+                    self.assertGreater(cache.hits, 0)
+
+            # A modified file is hashed again.
+            with open(os.path.join(self.dir, "odd"), "r+b") as fh:
+                fh.write(b"modified")
+            os.utime(os.path.join(self.dir, "odd"), ns=(0, 0))
+
+            with _CountingCache(path) as cache:
+                self.assertEqual(self.expected(), self.hash(cache=cache))
+
+        def test_resume(self):
+            journal = os.path.join(self.tmp, "x.journal")
+
+            for options in [{}, {'workers': 3, 'read_size': 4096},
+                            {'align_files': True}]:
+                align_files = options.get('align_files', False)
+
+                def progress(done, total):
+                    if done > total // 2:
+                        raise _Stop()
+
+                with self.assertRaises(_Stop):
+                    self.hash(journal=journal, checkpoint_interval=0,
+                              progress=progress, **options)
+
+                for path in _Journal.paths(journal):
+                    self.assertTrue(os.path.exists(path), path)
+
+                # Hashing continues after the checkpointed pieces.
+                reports = []
+                self.assertEqual(self.expected(align_files), self.hash(
+                    journal=journal, resume=True,
+                    progress=lambda *args: reports.append(args), **options))
+                self.assertGreater(reports[0][0], 0)
+
+                # A journal of other files is ignored.
+                with open(self.paths[0], "ab") as fh:
+                    fh.write(b"x")
+                self.paths[0], self.paths[-1] = self.paths[-1], self.paths[0]
+
+                self.assertEqual(self.expected(align_files),
+                                 self.hash(journal=journal, resume=True,
+                                           **options))
+
+        def test_update_prefix(self):
+            for align_files in [False, True]:
+                expected = self.expected(align_files)
+
+                # A torrent of the first files.
+                count = len(self.files) // 2
+                info  = create_multi_file_info(self.dir, self.files[:count],
+                                               PIECE_LENGTH,
+                                               align_files=align_files)
+                info['piece length'] = PIECE_LENGTH
+                metainfo = bdecode(bencode({'info': info}),
+                                   decode_strings=False)
+
+                prefix = get_update_prefix(metainfo, self.dir, self.files,
+                                           align_files=align_files)
+                self.assertLessEqual(len(prefix[0]), len(info['pieces']))
+                self.assertEqual(expected['md5sums'][:count],
+                                 prefix[1][:count])
+
+                for options in [{}, {'workers': 3, 'read_size': 4096}]:
+                    self.assertEqual(expected, self.hash(
+                        prefix=prefix, align_files=align_files, **options))
+
+                # Changed data is detected (the first piece is always
+                # checked).
+                with open(self.paths[0], "r+b") as fh:
+                    original = fh.read(1)
+                    fh.seek(0)
+                    fh.write(bytes([original[0] ^ 1]))
+                with self.assertRaises(ValueError):
+                    get_update_prefix(metainfo, self.dir, self.files,
+                                      align_files=align_files)
+
+                with open(self.paths[0], "r+b") as fh:
+                    fh.write(original)
+
+        def test_v2(self):
+            piece_length = 2 * BLOCK_SIZE
+
+            for workers in [1, 2]:
+                info, layers = create_v2_info(self.dir, self.files,
+                                              piece_length, workers=workers)
+                self.assertEqual(2, info['meta version'])
+                self.assertEqual("data", info['name'])
+                self.assertNotIn('pieces', info)
+
+                for file, path in zip(self.files, self.paths):
+                    entry = info['file tree']
+                    for part in split_path(file):
+                        entry = entry[part]
+
+                    root, layer = _v2_hashes(path, piece_length)
+                    self.assertEqual(os.path.getsize(path),
+                                     entry['']['length'])
+                    self.assertEqual(root, entry[''].get('pieces root'))
+                    self.assertEqual(layer, layers.get(root) if layer
+                                     else None, file)
+
+        def test_hybrid(self):
+            piece_length = 2 * BLOCK_SIZE
+
+            info, _ = create_v2_info(self.dir, self.files, piece_length,
+                                     hybrid=True, include_md5=True,
+                                     workers=2)
+
+            # The v1 part is that of the files in the order of the file
+            # tree, each starting on a piece boundary.
+            files = [file for file in info['files']
+                     if 'p' not in file.get('attr', '')]
+            paths = [os.path.join(self.dir, *file['path']) for file in files]
+            self.assertEqual(sorted(self.paths), sorted(paths))
+
+            result = hash_files(paths, piece_length, True, align_files=True)
+            self.assertEqual(bytes(result['pieces']), bytes(info['pieces']))
+            self.assertEqual(result['md5sums'],
+                             [file['md5sum'] for file in files])
+            self.assertEqual(sum(result['lengths']) + sum(result['pads']),
+                             sum(file['length'] for file in info['files']))
+
+            # Single files.
+            path    = os.path.join(self.dir, "odd")
+            info, _ = create_v2_info(path, None, piece_length, hybrid=True)
+            self.assertEqual(_v2_hashes(path, piece_length)[0],
+                             info['file tree']['odd']['']['pieces root'])
+            self.assertEqual(bytes(hash_files([path],
+                                              piece_length)['pieces']),
+                             bytes(info['pieces']))
+
+        def test_align(self):
+            self.check_variants([{}, {'workers': 3, 'read_size': 4096},
+                                 {'mmap_threshold': 0, 'io_depth': 2}],
+                                align_files=True)
+
+            info = create_multi_file_info(self.dir, self.files, PIECE_LENGTH,
+                                          align_files=True)
+            pads = [file['length'] for file in info['files']
+                    if file.get('attr') == 'p']
+            self.assertEqual([pad for pad in self.expected(True)['pads']
+                              if pad], pads)
+            self.assertTrue(all(file['path'] == ['.pad', str(file['length'])]
+                                for file in info['files']
+                                if file.get('attr') == 'p'))
+
+        def test_large_reads(self):
+            # Reads of several pieces at a time.
+            self.check_variants([{'read_size': 65536},
+                                 {'read_size': 65536, 'workers': 4},
+                                 {'read_size': 3 * PIECE_LENGTH + 5},
+                                 {'read_size': 2**20, 'workers': 2}])
+
+        def test_gentle(self):
+            self.check_variants([{'drop_cache': True},
+                                 {'drop_cache': True, 'read_size': 4096,
+                                  'workers': 2},
+                                 {'max_read_rate': 2**40}])
+
+            # The reads are limited to the given rate.
+            path  = os.path.join(self.dir, "big")
+            start = time.monotonic()
+            self.assertEqual(self.expected(paths=[path]),
+                             self.hash([path], max_read_rate=MIB))
+            self.assertGreaterEqual(time.monotonic() - start,
+                                    0.9 * 300000 / MIB)
+
+        def make_links(self):
+            # A symlink to a directory listed before, a symlink loop, a
+            # symlink to a file listed before and one listed before its
+            # target, which has a hardlink.
+            os.symlink(os.path.join(self.dir, "many"),
+                       os.path.join(self.dir, "many_link"))
+            os.symlink(self.dir, os.path.join(self.dir, "many", "loop"))
+            os.symlink(os.path.join(self.dir, "odd"),
+                       os.path.join(self.dir, "odd_link"))
+
+            self.write("z/real", b"real")
+            os.link(os.path.join(self.dir, "z", "real"),
+                    os.path.join(self.dir, "z", "hard"))
+            os.symlink(os.path.join(self.dir, "z", "real"),
+                       os.path.join(self.dir, "a_link"))
+
+            self.write("Upper/File", b"x")
+            self.write("lower/file", b"x")
+
+        def test_walk(self):
+            self.make_links()
+            expected = _old_listing(self.dir)
+
+            self.assertIn("a_link", expected)
+            self.assertIn(os.path.join("z", "hard"), expected)
+            self.assertNotIn(os.path.join("z", "real"), expected)
+            self.assertNotIn("odd_link", expected)
+
+            self.assertEqual(expected, get_files_in_directory(self.dir))
+
+            # Each entry is stat()-ed once, the result is returned.
+            listing = get_files_in_directory(self.dir, with_stat=True)
+            self.assertEqual(expected, [file for file, _ in listing])
+            for file, st in listing:
+                self.assertEqual(os.stat(os.path.join(self.dir, file)), st)
+
+            # Paths relative to another directory.
+            self.assertEqual([os.path.join("data", file)
+                              for file in expected],
+                             get_files_in_directory(self.dir,
+                                                    relative_to=self.tmp))
+
+        def test_scan_workers(self):
+            self.make_links()
+            for i in range(30):
+                for name in ["%d/a" % i, "%d/B/c" % i, "%d/b/d" % i]:
+                    self.write(name, b"x")
+
+            expected = get_files_in_directory(self.dir, with_stat=True)
+            self.assertEqual(_old_listing(self.dir),
+                             [file for file, _ in expected])
+
+            for workers in [2, 3, 16]:
+                self.assertEqual(expected, get_files_in_directory(
+                    self.dir, with_stat=True, workers=workers), workers)
+
+        def test_scan_ahead(self):
+            for i in range(50):
+                self.write("wide/%02d/x" % i, b"x")
+
+            # Listing the first subdirectory takes long; meanwhile only a
+            # few others may be listed ahead.
+            scandir = os.scandir
+            listed  = []
+            counts  = []
+            done    = threading.Event()
+
+            def slow_scandir(path):
+                listed.append(path)
+                if os.path.basename(path) == "00":
+                    done.wait(10)
+                return scandir(path)
+
+            def count():
+                counts.append(len(listed))
+                done.set()
+
+            os.scandir = slow_scandir
+            timer      = threading.Timer(0.5, count)
+            timer.start()
+            try:
+                files = get_files_in_directory(os.path.join(self.dir, "wide"),
+                                               workers=2)
+            finally:
+                os.scandir = scandir
+                timer.cancel()
+
+            self.assertEqual(["%02d/x" % i for i in range(50)],
+                             [file.replace(os.sep, "/") for file in files])
+            self.assertLessEqual(counts[0], 1 + 2 * 2)
+
+        def test_exclusions(self):
+            self.make_links()
+            self.write("x.tmp", b"x")
+            self.write("many/CACHE/x", b"x")
+            self.write("aab", b"x")
+            self.write("many/skip.me", b"x")
+
+            def abspaths(*paths):
+                return frozenset(os.path.normcase(os.path.join(self.dir, p))
+                                 for p in paths)
+
+            for paths, regexps in [
+                    (abspaths("many"), []),
+                    (abspaths("odd", "z/real", "nothing", "many/05"), []),
+                    (abspaths("z"), [r"\.tmp$"]),
+                    (frozenset(), [r"\.tmp$", (r"cache", re.IGNORECASE),
+                                   r"(\w)\1", r"(?i)SKIP\.ME$"]),
+                    (abspaths("many/CACHE", "Upper"), [r"^$", r"[0-9]$"])]:
+                regexps = frozenset(re.compile(*regexp)
+                                    if isinstance(regexp, tuple)
+                                    else re.compile(regexp)
+                                    for regexp in regexps)
+
+                self.assertEqual(
+                    _old_listing(self.dir, paths, regexps),
+                    get_files_in_directory(self.dir, excluded_paths=paths,
+                                           excluded_regexps=regexps),
+                    (paths, regexps))
+
+        def test_prefetch(self):
+            self.check_variants([{'prefetch_depth': 0},
+                                 {'prefetch_depth': 1},
+                                 {'prefetch_depth': 4,
+                                  'small_file_size': 60000, 'workers': 2},
+                                 {'prefetch_depth': 16,
+                                  'small_file_size': 2**20,
+                                  'read_size': 4096}])
+
+        def test_io_depth(self):
+            self.check_variants([{'io_depth': 2},
+                                 {'io_depth': 4, 'read_size': 8192,
+                                  'workers': 3},
+                                 {'io_depth': 16, 'read_size': 4096,
+                                  'prefetch_depth': 0}])
+
+        def test_sparse(self):
+            # A file that is nothing but a hole.
+            with open(os.path.join(self.dir, "hole"), "wb") as fh:
+                fh.truncate(3 * PIECE_LENGTH + 17)
+            self.files = get_files_in_directory(self.dir)
+            self.paths = [os.path.join(self.dir, f) for f in self.files]
+
+            self.check_variants([{}, {'mmap_threshold': 0},
+                                 {'read_size': 5000, 'workers': 3},
+                                 {'io_depth': 4, 'read_size': 4096},
+                                 {'prefetch_depth': 4,
+                                  'small_file_size': 2**20}])
+
+        def test_checksums(self):
+            expected = self.expected()
+            expected['sha256sums'] = [self.checksum('sha256', path)
+                                      for path in self.paths]
+
+            for options in [{}, {'workers': 3, 'read_size': 4096}]:
+                self.assertEqual(expected, self.hash(include_sha256=True,
+                                                     **options))
+
+            result = hash_files(self.paths, PIECE_LENGTH, include_sha256=True)
+            self.assertIsNone(result['md5sums'])
+            self.assertEqual(expected['sha256sums'], result['sha256sums'])
+
+            sha256sums = {}
+            info = create_multi_file_info(self.dir, self.files, PIECE_LENGTH,
+                                          sha256sums=sha256sums)
+            self.assertEqual(dict(zip(self.files, expected['sha256sums'])),
+                             sha256sums)
+            self.assertEqual(expected['md5sums'],
+                             [file['md5sum'] for file in info['files']])
+
+        def test_sha256sums_option(self):
+            self.write("new\nline", b"x")
+            torrent  = os.path.join(self.tmp, "x.torrent")
+            manifest = os.path.join(self.tmp, "SHA256SUMS")
+
+            self.assertEqual(0, main(["py3createtorrent", self.dir, "-o",
+                                      torrent, "--md5", "--sha256sums",
+                                      manifest]))
+
+            with open(torrent, "rb") as fh:
+                info = bdecode(fh.read())['info']
+            with open(manifest, encoding="utf-8") as fh:
+                lines = fh.read().splitlines()
+
+            files = ["/".join(file['path']) for file in info['files']]
+            self.assertEqual(len(files), len(lines))
+            for file, line in zip(files, lines):
+                path = os.path.join(self.dir, *file.split("/"))
+                if "\n" in file:
+                    self.assertEqual("\\%s  %s"
+                                     % (self.checksum('sha256', path),
+                                        file.replace("\n", "\\n")), line)
+                else:
+                    self.assertEqual("%s  %s" % (self.checksum('sha256',
+                                                               path), file),
+                                     line)
+
+            self.assertEqual([self.checksum('md5', os.path.join(
+                                  self.dir, *file['path']))
+                              for file in info['files']],
+                             [file['md5sum'] for file in info['files']])
+
+        def test_write_bencoded(self):
+            path = os.path.join(self.tmp, "x.torrent")
+            data = {'info': {'name': 'x', 'pieces': os.urandom(40)}}
+
+            write_bencoded(path, data)
+            with open(path, "rb") as fh:
+                self.assertEqual(bencode(data), fh.read())
+
+            # A failure while writing leaves the file as it was.
+            with self.assertRaises(TypeError):
+                write_bencoded(path, {'info': {'name': 'y', 'bad': 1.5}})
+
+            with open(path, "rb") as fh:
+                self.assertEqual(bencode(data), fh.read())
+            self.assertEqual(["data", "x.torrent"], sorted(os.listdir(
+                self.tmp)))
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -0,0 +1,574 @@
+#!/usr/bin/env python3
+"""
+Lazy, offset-indexed access to the contents of existing torrent files.
+
+Licensed according to GPL v3.
+"""
+
+import hashlib
+import mmap
+import os
+import random
+
+from py3bencode import (_key_bytes, bdecode, DecodingException,
+                        TORRENT_BINARY_KEYS)
+from py3createtorrent import (_hash_range, get_files_in_directory,
+                              split_path, UPDATE_SAMPLES)
+
+__all__ = ['TorrentIndex']
+
+class TorrentIndex(object):
+    """
+    Index of the byte offsets of the values within bencoded data.
+
+    Nothing is decoded up front. When a value is looked up, only the
+    dictionaries and lists on its way are scanned, recording the offsets of
+    their keys and items, and the scans are kept for later lookups. Values
+    are skipped without decoding them, strings by their length prefix, so
+    long strings like the pieces of a torrent cost nothing. The ends of the
+    lists and dictionaries passed while skipping a value are kept as well
+    (down to its grandchildren), so scanning them later does not walk their
+    items again. The infohash is the SHA-1 of the raw span of the info
+    dictionary, so the torrent is never bencoded again.
+
+    Paths to values are given as dictionary keys (str or bytes) and list
+    indices, e.g. index.get('info', 'files', 0, 'length').
+
+    The data is not validated beyond what is needed to find the values;
+    use bdecode() for that.
+    """
+    def __init__(self, data):
+        """
+        @param data: the bencoded data (bytes, bytearray or mmap).
+        """
+        self.data = data
+
+        # The entries of the containers scanned so far, by offset.
+        self._containers = {}
+
+        # The ends of the containers skipped so far, by offset.
+        self._ends = {}
+
+        # The spans of the v1 pieces and files, see _v1_info().
+        self._v1 = None
+
+    @classmethod
+    def open(cls, path):
+        """Return the index of the given torrent file, mapped into memory."""
+        with open(path, "rb") as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(data)
+
+    @classmethod
+    def matches_data(cls, path, node, samples=UPDATE_SAMPLES):
+        """
+        Return whether the torrent file at the given path describes the
+        given file or directory, i.e. has its name and the same files with
+        the same sizes, and a sample of its pieces (the first, the last and
+        some random ones) is hashed again and found unchanged, as the data
+        may have changed without changing the sizes. Only the file list and
+        the sampled pieces of the torrent are read.
+
+        Torrents that cannot be read, including v2-only torrents (which
+        have no v1 pieces), do not match.
+        """
+        node = os.path.abspath(node)
+
+        try:
+            with cls.open(path) as index:
+                if index.get('info', 'name') != os.path.basename(node):
+                    return False
+
+                single       = b'files' not in index.keys('info')
+                piece_length = index.get('info', 'piece length')
+                files        = [index.file(i)
+                                for i in range(index.file_count())]
+
+                count   = index.piece_count()
+                indices = {0, count - 1} | \
+                          set(random.sample(range(count), min(samples, count)))
+                pieces  = {i: index.piece(i) for i in indices if i >= 0}
+
+            if single != os.path.isfile(node):
+                return False
+
+            # The stream formed by the files, the padding files are zeros.
+            paths  = []
+            starts = []
+            ends   = []
+            offset = 0
+
+            for file in files:
+                if 'p' not in file.get('attr', ''):
+                    paths.append(node if single else
+                                 os.path.join(node, *file['path']))
+                    starts.append(offset)
+                    ends.append(offset + file['length'])
+                elif not paths:
+                    return False
+
+                offset += file['length']
+
+            starts.append(offset)
+
+            if count != -(-offset // piece_length):
+                return False
+
+            if single:
+                if files[0]['length'] != os.path.getsize(node):
+                    return False
+            else:
+                expected = {tuple(split_path(file)):
+                            os.path.getsize(os.path.join(node, file))
+                            for file in get_files_in_directory(node)}
+                if expected != {tuple(file['path']): file['length']
+                                for file in files
+                                if 'p' not in file.get('attr', '')}:
+                    return False
+
+            return all(_hash_range(paths, starts, ends, i * piece_length,
+                                   piece_length) == digest
+                       for i, digest in pieces.items())
+        except (OSError, TypeError, ValueError, KeyError, IndexError,
+                DecodingException):
+            return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the data (unmapping it if it was opened from a file)."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+        self._containers = {}
+        self._ends       = {}
+        self._v1         = None
+
+    def span(self, *path):
+        """
+        Return the tuple (start, end) of the bencoded value at the given
+        path within the data.
+
+        Raise KeyError or IndexError if there is no such value.
+        """
+        if not path:
+            return 0, self._skip(0)
+
+        start = 0
+        for key in path:
+            entries = self._scan(start)
+
+            if isinstance(key, int):
+                if not isinstance(entries, list):
+                    raise IndexError(key)
+                start, end = entries[key]
+            else:
+                if not isinstance(entries, dict):
+                    raise KeyError(key)
+                start, end = entries[_key_bytes(key)]
+
+        return start, end
+
+    def raw(self, *path):
+        """Return the bencoded value at the given path as bytes."""
+        start, end = self.span(*path)
+        return bytes(self.data[start:end])
+
+    def get(self, *path, decode_strings=True):
+        """
+        Return the decoded value at the given path.
+
+        Strings are decoded like bdecode() does, except for the values of
+        TORRENT_BINARY_KEYS (e.g. the pieces), which are returned as bytes.
+        """
+        if any(isinstance(key, (str, bytes)) and
+               _key_bytes(key) in TORRENT_BINARY_KEYS for key in path):
+            decode_strings = False
+
+        return bdecode(self.raw(*path), decode_strings,
+                       raw_keys=TORRENT_BINARY_KEYS)
+
+    def keys(self, *path):
+        """Return the keys (as bytes) of the dictionary at the given path."""
+        entries = self._scan(self.span(*path)[0])
+        if not isinstance(entries, dict):
+            raise DecodingException("Not a dictionary.")
+
+        return list(entries)
+
+    def __contains__(self, key):
+        return _key_bytes(key) in self._scan(0)
+
+    def length(self, *path):
+        """Return the number of items of the list/dictionary at the path."""
+        return len(self._scan(self.span(*path)[0]))
+
+    def infohash(self):
+        """Return the SHA-1 hash of the raw info dictionary (as bytes)."""
+        start, end = self.span('info')
+        return hashlib.sha1(memoryview(self.data)[start:end]).digest()
+
+    def _v1_info(self):
+        """
+        Return a tuple (pieces, files), where pieces is the tuple (start,
+        end) of the concatenated piece hashes and files the list of the
+        spans of the entries of the file list (None for single file
+        torrents). Both are looked up once and kept.
+
+        Raise ValueError if the torrent is v2-only, i.e. has neither the v1
+        pieces nor the v1 file list.
+        """
+        if self._v1 is None:
+            entries = self._scan(self.span('info')[0])
+            if not isinstance(entries, dict):
+                raise DecodingException("Not a dictionary.")
+
+            if b'pieces' not in entries:
+                raise ValueError("no v1 pieces (v2-only torrent)")
+
+            files = None
+            if b'files' in entries:
+                files = self._scan(entries[b'files'][0])
+                if not isinstance(files, list):
+                    raise DecodingException("Not a list.")
+
+            self._v1 = self._string('info', 'pieces'), files
+
+        return self._v1
+
+    def file_count(self):
+        """
+        Return the number of files of the torrent (including padding
+        files). Single file torrents have one file.
+
+        Raise ValueError for v2-only torrents.
+        """
+        files = self._v1_info()[1]
+        return 1 if files is None else len(files)
+
+    def file(self, index):
+        """
+        Return the decoded entry of the file with the given index, for
+        single file torrents the dictionary {'length': ..., 'path': [name]}.
+
+        Raise ValueError for v2-only torrents.
+        """
+        files = self._v1_info()[1]
+        if files is not None:
+            start, end = files[index]
+            return bdecode(self.data[start:end],
+                           raw_keys=TORRENT_BINARY_KEYS)
+
+        if index not in (0, -1):
+            raise IndexError(index)
+
+        return {'length': self.get('info', 'length'),
+                'path':   [self.get('info', 'name')]}
+
+    def piece_count(self):
+        """
+        Return the number of SHA-1 piece hashes of the torrent.
+
+        Raise ValueError for v2-only torrents.
+        """
+        start, end = self._v1_info()[0]
+        return (end - start) // 20
+
+    def piece(self, index):
+        """
+        Return the SHA-1 hash of the piece with the given index.
+
+        Raise ValueError for v2-only torrents.
+        """
+        start, end = self._v1_info()[0]
+        if index < 0:
+            index += (end - start) // 20
+
+        if not 0 <= index < (end - start) // 20:
+            raise IndexError(index)
+
+        return bytes(self.data[start + 20 * index:start + 20 * index + 20])
+
+    def _string(self, *path):
+        """Return the tuple (start, end) of the string at the given path."""
+        start, end = self.span(*path)
+        colon = self.data.find(b':', start, end)
+        if colon < 0:
+            raise DecodingException("Not a string.")
+
+        return colon + 1, end
+
+    def _scan(self, pos):
+        """
+        Return the entries of the dictionary (mapping the keys to the spans
+        of their values) or list (of the spans of its items) at the given
+        position. Strings and integers have no entries (None).
+        """
+        if pos in self._containers:
+            return self._containers[pos]
+
+        data   = self.data
+        char   = data[pos]
+        offset = pos
+
+        if char == 0x64:                                        # 'd'
+            entries = {}
+            pos += 1
+            while self._char(pos) != 0x65:
+                if not 0x30 <= data[pos] <= 0x39:
+                    raise DecodingException("Invalid dictionary key (must "
+                                            "be string).")
+                start = self._skip(pos)
+                end   = self._skip(start)
+
+                key = bytes(data[data.find(b':', pos) + 1:start])
+                entries[key] = (start, end)
+                pos = end
+
+        elif char == 0x6c:                                      # 'l'
+            entries = []
+            pos += 1
+            while self._char(pos) != 0x65:
+                end = self._skip(pos)
+                entries.append((pos, end))
+                pos = end
+
+        else:
+            return None
+
+        self._containers[offset] = entries
+        self._ends[offset]       = pos + 1
+        return entries
+
+    def _char(self, pos):
+        """Return the byte at the given position, which must exist."""
+        if pos >= len(self.data):
+            raise DecodingException("Unexpected end of data. Unterminated "
+                                    "list/dictionary?")
+
+        return self.data[pos]
+
+    def _skip(self, pos):
+        """
+        Return the end of the bencoded value at the given position.
+
+        The ends of the lists and dictionaries passed on the way are kept
+        for later, down to the grandchildren of the value.
+        """
+        if pos in self._ends:
+            return self._ends[pos]
+
+        data   = self.data
+        length = len(data)
+        ends   = self._ends
+        starts = []
+
+        while True:
+            if pos >= length:
+                raise DecodingException("Unexpected end of data. "
+                                        "Unterminated list/dictionary?")
+
+            char = data[pos]
+
+            if 0x30 <= char <= 0x39:                            # '0'-'9'
+                colon = data.find(b':', pos)
+                if colon < 0:
+                    raise DecodingException("Unterminated string length.")
+
+                try:
+                    pos = colon + 1 + int(data[pos:colon])
+                except ValueError:
+                    raise DecodingException("Invalid string length.")
+
+                if pos > length:
+                    raise DecodingException("Unexpected end of data. String "
+                                            "too long.")
+
+            elif char == 0x6c or char == 0x64:                  # 'l', 'd'
+                if pos in ends:
+                    pos = ends[pos]
+                else:
+                    starts.append(pos)
+                    pos += 1
+                    continue
+
+            elif char == 0x65 and starts:                       # 'e'
+                start = starts.pop()
+                pos  += 1
+                if len(starts) < 3:
+                    ends[start] = pos
+
+            elif char == 0x69:                                  # 'i'
+                pos = data.find(b'e', pos + 1)
+                if pos < 0:
+                    raise DecodingException("Unterminated integer.")
+                pos += 1
+
+            else:
+                raise DecodingException("Invalid data at position %d." % pos)
+
+            if not starts:
+                return pos
+
+if __name__ == '__main__':
+    ##################
+    # RUN UNIT TESTS #
+    import tempfile
+    import unittest
+
+    from py3bencode import bencode
+    from py3createtorrent import create_v2_info, write_bencoded
+    from torrent import make_metainfo
+
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp  = tempfile.TemporaryDirectory()
+            self.node = os.path.join(self.tmp.name, "data")
+            os.makedirs(os.path.join(self.node, "sub"))
+
+            for name, size in [("a", 40000), ("sub/b", 70000), ("c", 10)]:
+                with open(os.path.join(self.node, name), "wb") as fh:
+                    fh.write(os.urandom(size))
+
+        def tearDown(self):
+            self.tmp.cleanup()
+
+        def make(self, node=None, name="x.torrent", **options):
+            path     = os.path.join(self.tmp.name, name)
+            metainfo = make_metainfo(node or self.node, piece_length=16384,
+                                     **options)
+            write_bencoded(path, metainfo)
+            return path, metainfo
+
+        def test_lookup(self):
+            path, metainfo = self.make(comment="\xe4")
+            info = metainfo['info']
+
+            with TorrentIndex.open(path) as index:
+                self.assertEqual(hashlib.sha1(bencode(info)).digest(),
+                                 index.infohash())
+                self.assertEqual("\xe4", index.get('comment'))
+                self.assertIn('info', index)
+                self.assertNotIn('nothing', index)
+                self.assertEqual(bencode(info), index.raw('info'))
+
+                self.assertEqual(len(info['pieces']) // 20,
+                                 index.piece_count())
+                self.assertEqual(info['pieces'][20:40], index.piece(1))
+                self.assertEqual(info['pieces'][-20:], index.piece(-1))
+                with self.assertRaises(IndexError):
+                    index.piece(index.piece_count())
+
+                self.assertEqual(3, index.file_count())
+                self.assertEqual(['sub', 'b'], index.file(2)['path'])
+                self.assertEqual(info['files'][0], index.file(0))
+
+        def test_single_file(self):
+            path, metainfo = self.make(os.path.join(self.node, "a"))
+
+            with TorrentIndex.open(path) as index:
+                self.assertEqual(1, index.file_count())
+                self.assertEqual({'length': 40000, 'path': ['a']},
+                                 index.file(0))
+                self.assertEqual(metainfo['info']['pieces'][:20],
+                                 index.piece(0))
+
+            self.assertTrue(TorrentIndex.matches_data(
+                path, os.path.join(self.node, "a")))
+            self.assertFalse(TorrentIndex.matches_data(path, self.node))
+
+        def test_v2_only(self):
+            files   = get_files_in_directory(self.node)
+            path    = os.path.join(self.tmp.name, "v2.torrent")
+            info, _ = create_v2_info(self.node, files, 16384)
+            write_bencoded(path, {'info': info})
+
+            with TorrentIndex.open(path) as index:
+                self.assertEqual(2, index.get('info', 'meta version'))
+                for method, args in [(index.piece_count, ()),
+                                     (index.piece, (0,)),
+                                     (index.file_count, ()),
+                                     (index.file, (0,))]:
+                    with self.assertRaisesRegex(ValueError, "no v1 pieces"):
+                        method(*args)
+
+            self.assertFalse(TorrentIndex.matches_data(path, self.node))
+
+        def test_matches_data(self):
+            path, _ = self.make()
+
+            self.assertTrue(TorrentIndex.matches_data(path, self.node))
+            self.assertTrue(TorrentIndex.matches_data(path, self.node + "/"))
+
+            # Aligned files, with padding files.
+            aligned, _ = self.make(name="aligned.torrent", align_files=True)
+            self.assertTrue(TorrentIndex.matches_data(aligned, self.node))
+
+            # Another name.
+            other = os.path.join(self.tmp.name, "other")
+            os.rename(self.node, other)
+            self.assertFalse(TorrentIndex.matches_data(path, other))
+            os.rename(other, self.node)
+
+            # The same data, modified in the first piece without changing
+            # its size (the first piece is always checked).
+            with open(os.path.join(self.node, "a"), "r+b") as fh:
+                fh.write(b"\x00" * 100)
+            self.assertFalse(TorrentIndex.matches_data(path, self.node))
+            self.assertFalse(TorrentIndex.matches_data(aligned, self.node))
+
+            # Another size, another file.
+            path, _ = self.make()
+            with open(os.path.join(self.node, "c"), "ab") as fh:
+                fh.write(b"x")
+            self.assertFalse(TorrentIndex.matches_data(path, self.node))
+
+            path, _ = self.make()
+            with open(os.path.join(self.node, "d"), "wb") as fh:
+                fh.write(b"x")
+            self.assertFalse(TorrentIndex.matches_data(path, self.node))
+
+            self.assertFalse(TorrentIndex.matches_data(
+                os.path.join(self.tmp.name, "missing.torrent"), self.node))
+
+        def test_many_files(self):
+            class Data(bytes):
+                # Counts the bytes looked at one by one.
+                reads = 0
+
+                def __getitem__(self, key):
+                    if isinstance(key, int):
+                        Data.reads += 1
+                    return bytes.__getitem__(self, key)
+
+            files = [{'length': i, 'path': ['d%d' % (i % 10), 'f%d' % i]}
+                     for i in range(2000)]
+            data  = Data(bencode({'info': {'files': files, 'name': 'x',
+                                           'piece length': 16384,
+                                           'pieces': os.urandom(20 * 100)}}))
+
+            # The reads needed to skip over everything once.
+            TorrentIndex(data).span()
+            once, Data.reads = Data.reads, 0
+
+            # The file list is walked once, not once per container on the
+            # way to it, nor per lookup.
+            index = TorrentIndex(data)
+            self.assertEqual(100, index.piece_count())
+            self.assertEqual(files, [index.file(i)
+                                     for i in range(index.file_count())])
+            self.assertEqual(files[-1], index.get('info', 'files', -1))
+            self.assertLess(Data.reads, 1.2 * once)
+
+            Data.reads = 0
+            for i in range(index.file_count()):
+                index.file(i)
+                index.piece(i % 100)
+            self.assertEqual(0, Data.reads)
+
+    unittest.main(testRunner=unittest.TextTestRunner(verbosity=2), exit=False)
@@ -1,11 +1,10 @@
 #!python3
 import sys
 import json
-from base64 import b64encode
 from py3createtorrent import main as maketorrent
+from torrentindex import TorrentIndex
+from atclient import upload_torrent
 from os.path import basename, exists
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
 from urllib.error import HTTPError
 import re
 
@@ -32,15 +31,11 @@ torrent_args.append('-f')
 torrent_args.append('https://academictorrents.com/announce.php')
 torrentname = basename(sys.argv[2]) + ".torrent"
 
-# if file exists, we assume torrent already created
-if not exists(torrentname):
+# if the torrent exists and still matches the data, we assume it is done
+if not exists(torrentname) or \
+   not TorrentIndex.matches_data(torrentname, sys.argv[2]):
     maketorrent(torrent_args)
 
-# get base64 of torrent
-f = open(torrentname, 'rb')
-b64_torrent = b64encode(f.read())
-f.close()
-
 # extract cookie args
 matches = re.match("uid=(.*);pass=(.*)", sys.argv[1])
 
@@ -61,19 +56,17 @@ post_params = {
     'category' : category,
     'tags' : sys.argv[7],
     'urllist' : sys.argv[8],
-    'file' : b64_torrent,
     'private': 'true'
 }
 
-data = urlencode(post_params).encode('utf-8')
-
-req = Request('https://academictorrents.com/apiv2/entry', data)
-
+# the torrent is streamed from its file (base64-encoded) along with the fields,
+# temporary failures of the server are retried
 try:
-    response = urlopen(req)
+    response = upload_torrent(torrentname, post_params,
+                              'https://academictorrents.com/apiv2/entry')
 except HTTPError as e:
     print(e)
-    response = e
+    response = e.read()
 
-print(response.read())
+print(response)
 